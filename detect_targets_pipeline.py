@@ -34,33 +34,106 @@ def main():
     from libs.derep_fastq import derep_fastq
     print 'Dereplicating raw fastq...'
     fastq_file = os.path.join(args.OutDir, 'derep_reads.fastq')
-    derep_fastq(args.InFastq, fastq_file)
-
-    # Run bowtie
-    print 'Running bowtie2 alignment...'
-    j_sam = os.path.join(args.OutDir, 'J_align.sam')
-    v_sam = os.path.join(args.OutDir, 'V_align.sam')
-    j_bowtie_cmd = '{0} --very-sensitive-local --reorder -x bowtie_indexes/J_w_phix_indexes -U {1} -S {2} -p {3}'
-    v_bowtie_cmd = '{0} --very-sensitive-local --reorder -x bowtie_indexes/V_indexes -U {1} -S {2} -p {3}'
-    j_bowtie_cmd = j_bowtie_cmd.format(args.Bowtie2exe, fastq_file, j_sam, num_cpu)
-    v_bowtie_cmd = v_bowtie_cmd.format(args.Bowtie2exe, fastq_file, v_sam, num_cpu)
-    subprocess.call(j_bowtie_cmd, shell=True)
-    subprocess.call(v_bowtie_cmd, shell=True)
+    derep_mem = None
+    if args.DerepMemMB is not None:
+        derep_mem = args.DerepMemMB * 1024 ** 2
+    derep_fastq(args.InFastq, fastq_file, mem_budget=derep_mem, num_cpu=num_cpu)
+
+    # Screen out phiX and vector reads before alignment
+    router, screened = None, None
+    if args.KmerScreen:
+        from libs.kmer_screen import KmerScreen, screen_fastq
+        from libs.output_router import sam_output_router
+        print 'Screening for contaminant reads...'
+        references = [('phiX', 'IG_fastas/phiX174.fasta')]
+        if args.VectorFasta is not None:
+            references.append(('pUPATrap', args.VectorFasta))
+        router = sam_output_router(args.OutDir)
+        screened_file = os.path.join(args.OutDir, 'derep_reads_screened.fastq')
+        screened = screen_fastq(fastq_file, screened_file, KmerScreen(references), router)
+        fastq_file = screened_file
+
+    # Only align reads without a cached alignment
+    from libs.bowtie_scheduler import run_alignments, start_alignments, wait_alignments, BOWTIE_OPTS
+    j_index = 'bowtie_indexes/J_w_phix_indexes'
+    v_index = 'bowtie_indexes/V_indexes'
+    cache = None
+    if args.Aligner == 'native':
+        # Align in process, without bowtie2 or SAM files
+        from libs.gene_aligner import GeneAligner
+        print 'Running native J/V alignment...'
+        aligner = GeneAligner('IG_fastas/J_genes_w_phix.fasta', 'IG_fastas/V_genes.fasta')
+        j_sam, v_sam = aligner.align_reads(fastq_file, num_cpu)
+    else:
+        align_fastq = fastq_file
+        if args.AlignCache is not None:
+            from libs.alignment_cache import AlignmentCache
+            print 'Checking alignment cache...'
+            cache = AlignmentCache(args.AlignCache, [j_index, v_index], BOWTIE_OPTS)
+            align_fastq = os.path.join(args.OutDir, 'derep_reads_uncached.fastq')
+            cache.split_fastq(fastq_file, align_fastq)
+
+        # Run bowtie, J and V alignments at the same time
+        print 'Running bowtie2 alignment...'
+        if args.StreamSAM:
+            # Read the SAMs from bowtie2's stdout as they are produced
+            from libs.sam_stream import SamStream
+            procs = start_alignments(args.Bowtie2exe, align_fastq, [(j_index, None), (v_index, None)],
+                                     num_cpu)
+            audits = []
+            streams = []
+            for (_, proc), bam_name in zip(procs, ['J_align.bam', 'V_align.bam']):
+                tee = None
+                if args.AuditBAM:
+                    # Keep a copy of the SAM as a compressed BAM
+                    audit_cmd = '{0} view -b -S -o {1} -'.format(args.Samtoolsexe,
+                                                              os.path.join(args.OutDir, bam_name))
+                    audit = subprocess.Popen(audit_cmd, shell=True, stdin=subprocess.PIPE)
+                    audits.append((audit_cmd, audit))
+                    tee = audit.stdin
+                streams.append(SamStream(proc.stdout, tee))
+            j_sam, v_sam = streams
+        else:
+            j_sam = os.path.join(args.OutDir, 'J_align.sam')
+            v_sam = os.path.join(args.OutDir, 'V_align.sam')
+            for cmd, return_code in run_alignments(args.Bowtie2exe, align_fastq,
+                                                   [(j_index, j_sam), (v_index, v_sam)], num_cpu):
+                if return_code != 0:
+                    print 'bowtie2 failed with exit code {0}: {1}'.format(return_code, cmd)
+                    return 1
 
     # Process sams
     from libs.process_target_sam import parse_sams
     print 'Processing SAM files...'
-    ref_names, metrics, ndn_fastq = parse_sams(j_sam, v_sam, args.OutDir, fastq_file)
+    sam_cpu = num_cpu if args.ParallelSAM else 1
+    ref_names, metrics, ndn_fastq = parse_sams(j_sam, v_sam, args.OutDir, fastq_file,
+                                               indexed=args.IndexedReads,
+                                               one_pass=args.OnePassNDN,
+                                               num_cpu=sam_cpu,
+                                               router=router,
+                                               screened=screened,
+                                               cache=cache)
+
+    cache_stats = []
+    if cache is not None:
+        cache_stats = cache.stats()
+        cache.close()
+
+    # Check the streamed alignments finished cleanly
+    if args.StreamSAM and args.Aligner == 'bowtie2':
+        for _, audit in audits:
+            audit.stdin.close()
+        for cmd, return_code in wait_alignments(procs) + wait_alignments(audits):
+            if return_code != 0:
+                print 'Command failed with exit code {0}: {1}'.format(return_code, cmd)
+                return 1
 
     # Derep fastq
     print 'Dereplicating N-D-N sequences...'
     ndn_derep_fastq = os.path.join(args.OutDir, 'NDN_reads_derep.fastq')
-    derep_fastq(ndn_fastq, ndn_derep_fastq)
-
-    # Convert fastq to fasta for cd-hit
-    from libs.convert_fastq_to_fasta import convert_fastq_to_fasta
+    # Fasta for cd-hit is written alongside the fastq
     ndn_derep_fasta = os.path.join(args.OutDir, 'NDN_reads_derep.fasta')
-    convert_fastq_to_fasta(ndn_derep_fastq, ndn_derep_fasta)
+    derep_fastq(ndn_fastq, ndn_derep_fastq, num_cpu=num_cpu, out_fasta=ndn_derep_fasta)
 
     # Make CD-HIT command template
     cdhit_templ = ['{0} -i {1} -o {2}',        # Script, input, output
@@ -92,10 +165,13 @@ def main():
         # Make consensus
         print 'Making consensus sequences step{0}...'.format(i)
         cons_fastq_out = os.path.join(args.OutDir, 'NDN_clusters_step{0}.fastq.consensus'.format(i))
-        num_of_clusters, total_clusters_size = make_consensus(in_fastq, clstr_meta, cons_fastq_out, num_cpu)
-        # Convert fastq consensus to fasta
         cons_fasta_out = os.path.join(args.OutDir, 'NDN_clusters_step{0}.fasta.consensus'.format(i))
-        convert_fastq_to_fasta(cons_fastq_out, cons_fasta_out)
+        cons_stats_out = os.path.join(args.OutDir, 'NDN_clusters_step{0}.consensus_quals.tsv'.format(i))
+        num_of_clusters, total_clusters_size = make_consensus(in_fastq, clstr_meta, cons_fastq_out, num_cpu,
+                                                              indexed=args.IndexedReads,
+                                                              out_fasta=cons_fasta_out,
+                                                              recluster=args.Recluster,
+                                                              out_qual_stats=cons_stats_out)
         # Set input for next round
         in_fasta = cons_fasta_out
         in_fastq = cons_fastq_out
@@ -108,6 +184,7 @@ def main():
     process_clusters(cons_fasta_out, ref_names, metrics, targets_out)
 
     # Write a log file
+    from libs.output_router import format_stats
     log_file = os.path.join(args.OutDir, 'log_file.txt')
     with open(log_file, 'w') as out_h:
         out_h.write('Total number of reads:\t{0}\n'.format(metrics["total_count"]))
@@ -116,6 +193,13 @@ def main():
         out_h.write('phiX mapped reads:\t{0}\n'.format(metrics["phiX_count"]))
         out_h.write('CD19 CAR mapped reads:\t{0}\n'.format(metrics["pUPATrap_count"]))
         out_h.write('\n')
+        for line in format_stats(metrics['outputs']):
+            out_h.write(line + '\n')
+        out_h.write('\n')
+        if cache_stats:
+            for line in cache_stats:
+                out_h.write(line + '\n')
+            out_h.write('\n')
         out_h.write('Number of clusters:\t{0}\n'.format(num_of_clusters))
         out_h.write('Total reads in clusters:\t{0}\n'.format(total_clusters_size))
 
@@ -176,6 +260,62 @@ def parse_arguments():
                         required=False,
                         default=4,
                         help='Number of CPUs to use. (4)')
+    parser.add_argument('--DerepMemMB',
+                        metavar='<int>',
+                        type=int,
+                        required=False,
+                        default=None,
+                        help='Memory budget in MB for dereplicating the raw reads. If set, reads are spilled to disk in shards so the budget is not exceeded. (None)')
+    parser.add_argument('--StreamSAM',
+                        action='store_true',
+                        help='Read the bowtie2 SAM output through pipes rather than writing J_align.sam and V_align.sam to disk.')
+    parser.add_argument('--AuditBAM',
+                        action='store_true',
+                        help='With --StreamSAM, also keep the alignments as J_align.bam and V_align.bam using samtools.')
+    parser.add_argument('--Samtoolsexe',
+                        metavar='<str>',
+                        type=str,
+                        required=False,
+                        default='samtools',
+                        help="Location of samtools executable, used by --AuditBAM. (samtools)")
+    parser.add_argument('--OnePassNDN',
+                        action='store_true',
+                        help='Take the N-D-N regions from the seq and qual in the J SAM as each alignment is read, rather than rescanning the dereplicated fastq.')
+    parser.add_argument('--ParallelSAM',
+                        action='store_true',
+                        help='Classify the J/V alignment pairs in chunks across --numCPU processes.')
+    parser.add_argument('--KmerScreen',
+                        action='store_true',
+                        help='Divert phiX (and --VectorFasta) reads using a k-mer screen before running bowtie2.')
+    parser.add_argument('--VectorFasta',
+                        metavar='<str>',
+                        type=str,
+                        required=False,
+                        default=None,
+                        help='Fasta of the pUPATrap-CRV2 vector for --KmerScreen. (None)')
+    parser.add_argument('--AlignCache',
+                        metavar='<str>',
+                        type=str,
+                        required=False,
+                        default=None,
+                        help='sqlite3 file to cache alignments in across runs. Reads with a cached alignment are not aligned again. (None)')
+    parser.add_argument('--Aligner',
+                        metavar='<str>',
+                        type=str,
+                        required=False,
+                        default='bowtie2',
+                        choices=['bowtie2', 'native'],
+                        help='J/V aligner: bowtie2, or native for the in-process k-mer seeded aligner (ungapped, see extras/validate_gene_aligner.py). --AlignCache and --StreamSAM only apply to bowtie2. (bowtie2)')
+    parser.add_argument('--Recluster',
+                        metavar='<str>',
+                        type=str,
+                        required=False,
+                        default='exact',
+                        choices=['exact', 'indexed'],
+                        help='How cd-hit clusters are split by match probability: exact compares each member with every member of each group, indexed only with up to 32 representatives per group after a mismatch bound prefilter (faster on large clusters, see extras/compare_recluster_modes.py). (exact)')
+    parser.add_argument('--IndexedReads',
+                        action='store_true',
+                        help='Fetch reads by name from an mmapped index when processing SAMs and making consensus sequences, rather than rescanning or loading whole fastq files.')
 
 
     return parser.parse_args()
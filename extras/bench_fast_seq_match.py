@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Checks that the compiled libs/fast_seq_match.pyx gives the same results
+#  as the pure python sequences_match_prob and recluster_members loop, then
+#  times the two. Build the extension first with
+#    cd libs && python setup_cython.py build_ext --inplace
+#
+#  Use
+#    python extras/bench_fast_seq_match.py [num pairs]
+#
+
+import os
+import sys
+import random
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'libs'))
+import probabilistic_seq_match
+import make_cluster_consensus
+from probabilistic_seq_match import python_sequences_match_prob, base_prob
+from bio_file_parsers import phred_score_dict
+
+try:
+    import fast_seq_match
+except ImportError:
+    sys.exit('fast_seq_match is not built. Run: cd libs && python setup_cython.py build_ext --inplace')
+
+def main():
+
+    num_pairs = 20000
+    if len(sys.argv) > 1:
+        num_pairs = int(sys.argv[1])
+
+    rand = random.Random(1)
+    phred_dict = phred_score_dict(33)
+    base_prob_precompute = dict([(k, base_prob(v)) for k, v in phred_dict.items()])
+
+    # Pairs of aligned seqs, some similar, with Ns and '-' padding
+    pairs = []
+    for _ in range(num_pairs):
+        seq_len = rand.randint(1, 80)
+        a_seq, a_qual = random_read(rand, seq_len)
+        if rand.random() < 0.5:
+            b_seq = ''.join([x if rand.random() > 0.05 else rand.choice('ACGTN-') for x in a_seq])
+            b_qual = random_read(rand, seq_len)[1]
+        else:
+            b_seq, b_qual = random_read(rand, seq_len)
+        pairs.append((a_seq, a_qual, b_seq, b_qual, rand.choice([0, 1e-20, 1e-5])))
+
+    # Clusters of aligned members to recluster
+    clusters = []
+    for _ in range(max(num_pairs / 1000, 1)):
+        seq_len = rand.randint(20, 70)
+        bases = [random_read(rand, seq_len, 'ACGT')[0] for _ in range(rand.randint(1, 10))]
+        aligned = []
+        for i in range(rand.randint(50, 300)):
+            seq = ''.join([x if rand.random() > 0.01 else rand.choice('ACGTN') for x in rand.choice(bases)])
+            pad = rand.randint(0, 5)
+            seq = '-' * pad + seq[pad:]
+            qual = ''.join(['-' if x == '-' else chr(33 + rand.randint(20, 41)) for x in seq])
+            aligned.append(('read{0};size=1'.format(i), seq, qual))
+        clusters.append(aligned)
+
+    # Equivalence
+    python_probs = [python_sequences_match_prob(a, aq, b, bq, base_prob_precompute, t)
+                    for a, aq, b, bq, t in pairs]
+    fast_probs = [fast_seq_match.sequences_match_prob(a, aq, b, bq, base_prob_precompute, t)
+                  for a, aq, b, bq, t in pairs]
+    num_diff = sum([x != y for x, y in zip(python_probs, fast_probs)])
+    print 'sequences_match_prob differences: {0} of {1}'.format(num_diff, len(pairs))
+
+    python_groups = [python_recluster(x, base_prob_precompute) for x in clusters]
+    fast_groups = [fast_seq_match.recluster_members(x, base_prob_precompute) for x in clusters]
+    num_diff_groups = sum([x != y for x, y in zip(python_groups, fast_groups)])
+    print 'recluster_members differences: {0} of {1}'.format(num_diff_groups, len(clusters))
+
+    # Timing
+    print '\t'.join(['test', 'items', 'secs', 'items/s'])
+    timed('python sequences_match_prob', len(pairs),
+          lambda: [python_sequences_match_prob(a, aq, b, bq, base_prob_precompute, t)
+                   for a, aq, b, bq, t in pairs])
+    timed('compiled sequences_match_prob', len(pairs),
+          lambda: [fast_seq_match.sequences_match_prob(a, aq, b, bq, base_prob_precompute, t)
+                   for a, aq, b, bq, t in pairs])
+    timed('python recluster_members', len(clusters),
+          lambda: [python_recluster(x, base_prob_precompute) for x in clusters])
+    timed('compiled recluster_members', len(clusters),
+          lambda: [fast_seq_match.recluster_members(x, base_prob_precompute) for x in clusters])
+
+    if num_diff or num_diff_groups:
+        return 1
+    return 0
+
+def random_read(rand, seq_len, alphabet='ACGTN-'):
+    seq = ''.join([rand.choice(alphabet) for _ in range(seq_len)])
+    qual = ''.join([chr(33 + rand.randint(0, 41)) for _ in range(seq_len)])
+    return seq, qual
+
+def python_recluster(aligned, base_prob_precompute):
+    """ make_cluster_consensus.recluster_members with only the python loop.
+    """
+    saved = (make_cluster_consensus.fast_seq_match, probabilistic_seq_match.np,
+             make_cluster_consensus.sequences_match_prob)
+    make_cluster_consensus.fast_seq_match = None
+    probabilistic_seq_match.np = None
+    make_cluster_consensus.sequences_match_prob = python_sequences_match_prob
+    try:
+        return make_cluster_consensus.recluster_members(aligned, base_prob_precompute)
+    finally:
+        (make_cluster_consensus.fast_seq_match, probabilistic_seq_match.np,
+         make_cluster_consensus.sequences_match_prob) = saved
+
+def timed(name, num_items, func):
+    start = time.time()
+    result = func()
+    secs = time.time() - start
+    print '\t'.join([name, str(num_items), '{0:.2f}'.format(secs),
+                     '{0:.0f}'.format(num_items / secs)])
+    return result
+
+if __name__ == '__main__':
+	sys.exit(main())
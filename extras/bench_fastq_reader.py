@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Throughput benchmark of the readline based fastq_parser against the block
+#  based fastq_block_parser (strict and trusted modes) in libs/bio_file_parsers.
+#
+#  Use
+#    python extras/bench_fastq_reader.py [fastq]
+#  or with no fastq a synthetic file of 250 bp reads is written to a temp dir.
+#
+
+import os
+import sys
+import random
+import shutil
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from libs.bio_file_parsers import fastq_parser, fastq_block_parser, fastq_batch_parser
+
+def main():
+
+    tmp_dir = None
+    if len(sys.argv) > 1:
+        in_fastq = sys.argv[1]
+    else:
+        tmp_dir = tempfile.mkdtemp()
+        in_fastq = os.path.join(tmp_dir, 'synthetic.fastq')
+        write_synthetic_fastq(in_fastq, 200000, 250)
+
+    readers = [('fastq_parser', lambda h: fastq_parser(h)),
+               ('block strict', lambda h: fastq_block_parser(h)),
+               ('block trusted', lambda h: fastq_block_parser(h, strict=False)),
+               ('batch trusted', lambda h: batch_records(fastq_batch_parser(h, strict=False)))]
+
+    size_mb = os.path.getsize(in_fastq) / float(1024 ** 2)
+    print '\t'.join(['reader', 'records', 'secs', 'records/s', 'MB/s'])
+    expected = None
+    for name, reader in readers:
+        with open(in_fastq, 'rb') as in_handle:
+            start = time.time()
+            records = list(reader(in_handle))
+            secs = time.time() - start
+        # Every reader must give the same records
+        if expected is None:
+            expected = records
+        elif records != expected:
+            sys.exit('{0} records differ from fastq_parser'.format(name))
+        print '\t'.join([name,
+                         str(len(records)),
+                         '{0:.2f}'.format(secs),
+                         '{0:.0f}'.format(len(records) / secs),
+                         '{0:.1f}'.format(size_mb / secs)])
+
+    if tmp_dir:
+        shutil.rmtree(tmp_dir)
+
+    return 0
+
+def batch_records(batches):
+    for batch in batches:
+        for record in batch:
+            yield record
+
+def write_synthetic_fastq(out_file, num_reads, read_len, seed=1):
+    rand = random.Random(seed)
+    quals = '#+5:?@AEFGHI'
+    with open(out_file, 'w') as out_handle:
+        for i in range(num_reads):
+            seq = ''.join([rand.choice('ACGT') for _ in range(read_len)])
+            qual = ''.join([rand.choice(quals) for _ in range(read_len)])
+            out_handle.write('@M01996:13:000000000-A5U9G:1:1101:{0}:1 1:N:0:1\n'.format(i))
+            out_handle.write(seq + '\n+\n' + qual + '\n')
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Benchmark of memory per unique read for dereplication table keys, comparing
+#  plain str keys to 2-bit packed keys from libs/seq_keys.py, on a synthetic
+#  V-NDN-J repertoire.
+#
+#  Use
+#    python extras/bench_seq_keys.py [num unique reads] [N read fraction]
+#
+
+import os
+import sys
+import random
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from libs.seq_keys import pack_seq, unpack_seq
+
+def main():
+
+    num_reads = 200000
+    n_frac = 0.02
+    if len(sys.argv) > 1:
+        num_reads = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        n_frac = float(sys.argv[2])
+
+    reads = synthetic_repertoire(num_reads, n_frac)
+    print 'Unique reads: {0}'.format(len(reads))
+    print 'Mean read length: {0:.1f}'.format(sum([len(x) for x in reads]) / float(len(reads)))
+    print
+
+    # Str keys
+    start = time.time()
+    str_table = dict.fromkeys(reads)
+    str_time = time.time() - start
+
+    # Packed keys
+    start = time.time()
+    packed_table = dict.fromkeys([pack_seq(x) for x in reads])
+    packed_time = time.time() - start
+
+    # Check round trip
+    for key in packed_table:
+        assert unpack_seq(key) in str_table
+
+    print '\t'.join(['keys', 'bytes/key', 'bytes/dict slot', 'bytes/read', 'build secs'])
+    for name, table, secs in [('str', str_table, str_time),
+                              ('packed', packed_table, packed_time)]:
+        key_bytes = sum([sys.getsizeof(x) for x in table]) / float(len(table))
+        slot_bytes = sys.getsizeof(table) / float(len(table))
+        print '\t'.join([name,
+                         '{0:.1f}'.format(key_bytes),
+                         '{0:.1f}'.format(slot_bytes),
+                         '{0:.1f}'.format(key_bytes + slot_bytes),
+                         '{0:.2f}'.format(secs)])
+
+    return 0
+
+def synthetic_repertoire(num_reads, n_frac, seed=1):
+    """ Returns a list of unique reads made from a small pool of V and J like
+        segments joined by random N-D-N inserts. A fraction of reads get an N.
+    """
+    rand = random.Random(seed)
+    v_segs = [random_seq(rand, rand.randint(180, 200)) for _ in range(50)]
+    j_segs = [random_seq(rand, rand.randint(40, 60)) for _ in range(6)]
+
+    reads = set()
+    while len(reads) < num_reads:
+        read = rand.choice(v_segs) + random_seq(rand, rand.randint(5, 40)) + rand.choice(j_segs)
+        if rand.random() < n_frac:
+            pos = rand.randint(0, len(read) - 1)
+            read = read[:pos] + 'N' + read[pos + 1:]
+        reads.add(read)
+
+    return list(reads)
+
+def random_seq(rand, length):
+    return ''.join([rand.choice('ACGT') for _ in range(length)])
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Microbenchmark of the old dict lookup reverse complement against the
+#  translate based libs/seq_utils.reverse_complement, and of allocating the
+#  old process_target_sam Read class (with a __dict__) against the slotted
+#  Read.
+#
+#  Use
+#    python extras/bench_seq_utils.py [num seqs]
+#
+
+import os
+import sys
+import random
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'libs'))
+from libs.seq_utils import reverse_complement
+from libs.process_target_sam import Read
+
+class DictRead:
+    """ The previous Read, kept here for comparison.
+    """
+    def __init__(self, query_name):
+        self.query_name = str(query_name)
+        self.j_ref = None
+        self.v_ref = None
+        self.j_del = None
+        self.v_del = None
+        self.insert_start = 0
+        self.insert_end = -1
+        self.is_phix = False
+
+def main():
+
+    num_seqs = 200000
+    if len(sys.argv) > 1:
+        num_seqs = int(sys.argv[1])
+
+    rand = random.Random(1)
+    seqs = [''.join([rand.choice('ACGTN') for _ in range(rand.randint(50, 250))])
+            for _ in range(num_seqs)]
+    names = ['M01996:13:000000000-A5U9G:1:1101:{0}:1;size=1'.format(i) for i in range(num_seqs)]
+
+    print '\t'.join(['test', 'items', 'secs', 'items/s'])
+
+    # Reverse complements must agree
+    rev_comp_dict = {'A':'T', 'T':'A', 'G':'C', 'C':'G', 'N':'N'}
+    expected = timed('dict reverse complement', num_seqs,
+                     lambda: [dict_reverse_complement(x, rev_comp_dict) for x in seqs])
+    result = timed('translate reverse complement', num_seqs,
+                   lambda: [reverse_complement(x.upper()) for x in seqs])
+    if result != expected:
+        sys.exit('Reverse complements differ')
+
+    timed('Read with __dict__', num_seqs, lambda: [DictRead(x) for x in names])
+    timed('Read with __slots__', num_seqs, lambda: [Read(x) for x in names])
+    print 'Bytes per Read: __dict__ {0}, __slots__ {1}'.format(
+        sys.getsizeof(DictRead('x')) + sys.getsizeof(DictRead('x').__dict__),
+        sys.getsizeof(Read('x')))
+
+    return 0
+
+def timed(name, num_items, func):
+    start = time.time()
+    result = func()
+    secs = time.time() - start
+    print '\t'.join([name, str(num_items), '{0:.2f}'.format(secs),
+                     '{0:.0f}'.format(num_items / secs)])
+    return result
+
+def dict_reverse_complement(seq, rev_comp_dict):
+    """ The previous process_target_sam.reverse_complement.
+    """
+    rev_list = list(seq.upper())
+    return ''.join([rev_comp_dict[x] for x in rev_list])[::-1]
+
+if __name__ == '__main__':
+	main()
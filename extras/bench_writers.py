@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Benchmark of fasta writes per second: the old per-record write_fasta (4+
+#  handle.write calls per record), write_fasta as it is now (one write per
+#  record) and the buffered SeqWriter with and without line wrapping.
+#
+#  Use
+#    python extras/bench_writers.py [num records]
+#
+
+import os
+import sys
+import random
+import shutil
+import tempfile
+import time
+from math import ceil
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from libs.bio_file_parsers import write_fasta, SeqWriter, wrap
+
+def main():
+
+    num_records = 500000
+    if len(sys.argv) > 1:
+        num_records = int(sys.argv[1])
+
+    rand = random.Random(1)
+    records = [('M01996:13:000000000-A5U9G:1:1101:{0}:1;size=1'.format(i),
+                ''.join([rand.choice('ACGT') for _ in range(rand.randint(20, 250))]))
+               for i in range(num_records)]
+
+    tmp_dir = tempfile.mkdtemp()
+    out_file = os.path.join(tmp_dir, 'out.fasta')
+
+    print '\t'.join(['writer', 'records', 'secs', 'records/s', 'MB'])
+    for name, writer in [('legacy write_fasta', write_legacy),
+                         ('write_fasta', write_per_record),
+                         ('SeqWriter', write_buffered),
+                         ('SeqWriter no wrap', write_buffered_nowrap)]:
+        with open(out_file, 'w') as out_handle:
+            start = time.time()
+            writer(out_handle, records)
+            secs = time.time() - start
+        print '\t'.join([name,
+                         str(num_records),
+                         '{0:.2f}'.format(secs),
+                         '{0:.0f}'.format(num_records / secs),
+                         '{0:.1f}'.format(os.path.getsize(out_file) / float(1024 ** 2))])
+
+    shutil.rmtree(tmp_dir)
+
+    return 0
+
+def write_legacy(out_handle, records):
+    """ The previous write_fasta, kept here for comparison.
+    """
+    for header, seq in records:
+        num_lines = int(len(seq) / 79) + 1
+        len_line = int(ceil(float(len(seq))/num_lines))
+        out_handle.write('>')
+        out_handle.write(header)
+        out_handle.write('\n')
+        for seq_part in wrap(seq, len_line):
+            out_handle.write(seq_part)
+            out_handle.write('\n')
+
+def write_per_record(out_handle, records):
+    for header, seq in records:
+        write_fasta(out_handle, header, seq)
+
+def write_buffered(out_handle, records):
+    with SeqWriter(out_handle) as writer:
+        writer.write_records(records)
+
+def write_buffered_nowrap(out_handle, records):
+    with SeqWriter(out_handle, max_line=None) as writer:
+        writer.write_records(records)
+
+if __name__ == '__main__':
+	main()
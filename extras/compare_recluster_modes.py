@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Reports how often the indexed re-clustering mode (libs/indexed_recluster.py)
+#  splits cd-hit clusters differently from the exact recluster_members, and
+#  the time each takes. Takes the N-D-N fastq and cd-hit .clstr file given
+#  to make_cluster_consensus.make_consensus.
+#
+#  Use
+#    python extras/compare_recluster_modes.py <ndn fastq> <cd-hit clstr> [max reps]
+#
+
+import os
+import sys
+import re
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'libs'))
+from libs.bio_file_parsers import clstr_parser, phred_score_dict
+from libs.probabilistic_seq_match import base_prob
+from libs.make_cluster_consensus import (check_cluster_membership, make_fastq_dict,
+                                         recluster_members, choose_aligner)
+from libs.indexed_recluster import recluster_members_indexed, MAX_REPS
+
+COUNTS = ['clusters', 'clusters split differently', 'members', 'members grouped differently',
+          'groups exact', 'groups indexed']
+
+def main():
+
+    if len(sys.argv) < 3:
+        sys.exit('Use: compare_recluster_modes.py <ndn fastq> <cd-hit clstr> [max reps]')
+    ndn_fastq, clstr_meta = sys.argv[1:3]
+    max_reps = MAX_REPS
+    if len(sys.argv) > 3:
+        max_reps = int(sys.argv[3])
+
+    fastq_dict = make_fastq_dict(ndn_fastq)
+    pattern = re.compile(r">(.*)\.\.\..*((([0-9]+):([0-9]+):([0-9]+):([0-9]+))|\*)")
+    phred_dict = phred_score_dict(33)
+    base_prob_precompute = dict([(k, base_prob(v)) for k, v in phred_dict.items()])
+
+    counts = dict([(name, 0) for name in COUNTS])
+    secs = {'exact': 0.0, 'indexed': 0.0}
+
+    def compare_modes(aligned, base_prob_precompute):
+        """ Re-clusters with both modes, adding their differences to counts.
+        """
+        start = time.time()
+        exact = recluster_members(aligned, base_prob_precompute)
+        secs['exact'] += time.time() - start
+        start = time.time()
+        indexed = recluster_members_indexed(aligned, base_prob_precompute, max_reps)
+        secs['indexed'] += time.time() - start
+
+        counts['clusters'] += 1
+        counts['members'] += len(aligned)
+        counts['groups exact'] += len(exact)
+        counts['groups indexed'] += len(indexed)
+        exact_groups = member_groups(exact)
+        indexed_groups = member_groups(indexed)
+        num_diff = sum([exact_groups[x] != indexed_groups[x] for x in exact_groups])
+        if num_diff:
+            counts['clusters split differently'] += 1
+            counts['members grouped differently'] += num_diff
+        return exact
+
+    with open(clstr_meta, 'r') as in_handle:
+        for _, lines in clstr_parser(in_handle):
+            if len(lines) > 1:
+                check_cluster_membership(lines, fastq_dict, pattern, base_prob_precompute,
+                                         choose_aligner('numpy'), compare_modes)
+
+    for name in COUNTS:
+        print '{0}\t{1}'.format(name, counts[name])
+    if counts['members']:
+        print 'fraction of members grouped differently\t{0:.4f}'.format(
+            float(counts['members grouped differently']) / counts['members'])
+    print 'exact secs\t{0:.2f}'.format(secs['exact'])
+    print 'indexed secs\t{0:.2f}'.format(secs['indexed'])
+
+    return 0
+
+def member_groups(groups):
+    """ Returns a dict of each member header to the set of headers in its
+        group.
+    """
+    member_group = {}
+    for group in groups:
+        headers = frozenset([x[0] for x in group])
+        for header in headers:
+            member_group[header] = headers
+    return member_group
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  Reports the concordance of the in-process libs/gene_aligner.py with the
+#  bowtie2 J and V SAMs of the same dereplicated reads (as written by
+#  detect_targets_pipeline.py, i.e. with --reorder). For J and V separately,
+#  counts reads mapped by both, by only one or by neither, and of those
+#  mapped by both how many agree on reference, gene (ignoring the allele),
+#  strand and the fields Read.parse_J_attr/parse_V_attr use (J pos and
+#  qstart, V qend and aend).
+#
+#  Use
+#    python extras/validate_gene_aligner.py <derep fastq> <J sam> <V sam> [num cpu]
+#
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'libs'))
+from libs.gene_aligner import GeneAligner
+from libs.sam_stream import SamStream
+
+J_FASTA = 'IG_fastas/J_genes_w_phix.fasta'
+V_FASTA = 'IG_fastas/V_genes.fasta'
+
+COUNTS = ['reads', 'both mapped', 'bowtie2 only', 'native only', 'neither',
+          'same reference', 'same gene', 'same strand', 'same fields']
+
+def main():
+
+    if len(sys.argv) < 4:
+        sys.exit('Use: validate_gene_aligner.py <derep fastq> <J sam> <V sam> [num cpu]')
+    in_fastq, j_sam, v_sam = sys.argv[1:4]
+    num_cpu = 1
+    if len(sys.argv) > 4:
+        num_cpu = int(sys.argv[4])
+
+    start = time.time()
+    aligner = GeneAligner(J_FASTA, V_FASTA)
+    j_view, v_view = aligner.align_reads(in_fastq, num_cpu)
+
+    counts = {'J': dict([(name, 0) for name in COUNTS]),
+              'V': dict([(name, 0) for name in COUNTS])}
+    with open(j_sam, 'r') as j_handle:
+        with open(v_sam, 'r') as v_handle:
+            j_bowtie, v_bowtie = SamStream(j_handle), SamStream(v_handle)
+            for j_pair, v_pair in zip(zip(j_bowtie.fetch(), j_view.fetch()),
+                                      zip(v_bowtie.fetch(), v_view.fetch())):
+                compare(counts['J'], j_pair, j_bowtie, j_view, ['pos', 'qstart'])
+                compare(counts['V'], v_pair, v_bowtie, v_view, ['qend', 'aend'])
+    secs = time.time() - start
+
+    print '\t'.join(['count', 'J', 'V'])
+    for name in COUNTS:
+        print '\t'.join([name, str(counts['J'][name]), str(counts['V'][name])])
+    print 'Native alignment and comparison took {0:.1f} secs'.format(secs)
+
+    return 0
+
+def compare(counts, pair, bowtie, native, fields):
+    """ Adds the comparison of a bowtie2 and native alignment of one read to
+        counts.
+    """
+    bowtie_align, native_align = pair
+    if bowtie_align.qname != native_align.qname:
+        sys.exit('SAM and fastq reads are out of step at {0}'.format(bowtie_align.qname))
+    counts['reads'] += 1
+
+    if bowtie_align.is_unmapped or native_align.is_unmapped:
+        if not bowtie_align.is_unmapped:
+            counts['bowtie2 only'] += 1
+        elif not native_align.is_unmapped:
+            counts['native only'] += 1
+        else:
+            counts['neither'] += 1
+        return
+    counts['both mapped'] += 1
+
+    bowtie_ref = bowtie.getrname(bowtie_align.rname)
+    native_ref = native.getrname(native_align.rname)
+    if bowtie_ref == native_ref:
+        counts['same reference'] += 1
+    if bowtie_ref.split('*')[0] == native_ref.split('*')[0]:
+        counts['same gene'] += 1
+    if bowtie_align.is_reverse == native_align.is_reverse:
+        counts['same strand'] += 1
+    if bowtie_ref == native_ref and all([getattr(bowtie_align, field) == getattr(native_align, field)
+                                         for field in fields]):
+        counts['same fields'] += 1
+
+if __name__ == '__main__':
+	main()
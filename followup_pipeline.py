@@ -13,7 +13,8 @@ def main(args):
     # Make bowtie indexes
     from libs.create_target_indexes import make_indexes
     targets_prefix = os.path.join(args['out_dir'], 'targets')
-    target_names = make_indexes(args['in_clusters'], targets_prefix, 0.05)
+    target_names = make_indexes(args['in_clusters'], targets_prefix, 0.05,
+                                cache_dir=args['index_cache'])
     
     # Derep fastq
     from libs.derep_fastq import derep_fastq
@@ -38,5 +39,9 @@ if __name__ == '__main__':
     args['in_clusters'] = sys.argv[1]
     args['in_fastq'] = sys.argv[2]
     args['out_dir'] = sys.argv[3]
+    # Optional directory of cached target indexes, shared between runs
+    args['index_cache'] = None
+    if len(sys.argv) > 4:
+        args['index_cache'] = sys.argv[4]
     
     main(args)
@@ -58,7 +58,8 @@ def main():
     
     # Install pysam using pip
     cmd = ' '.join(['pip install pysam',
-                    'pandas'])
+                    'pandas',
+                    'cython'])
     ret = subprocess.call(cmd, shell=True)        
     if not ret == 0:
         print ('pysam was not succesfully installed. Exiting.')
@@ -67,6 +68,13 @@ def main():
     # Install bowtie2 and cd-hit-est
     subprocess.call('bash libs/install_programs.sh', shell=True)
     
+    # Build the Cython extensions. The pipeline falls back to pure python
+    # versions if this fails.
+    ret = subprocess.call('cd libs && python setup_cython.py build_ext --inplace', shell=True)
+    if not ret == 0:
+        print ('Cython extensions were not built. The slower python ' +
+               'versions will be used.')
+    
     
     print 'Done.'
 
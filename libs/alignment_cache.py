@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Persistent cache of J and V alignment results for dereplicated reads, so
+# that reads already seen in an earlier run (e.g. the diagnostic sample of
+# the same patient) don't need to be aligned again. Stored in an sqlite3
+# database. Each read is keyed on a sha1 of its sequence together with a
+# checksum of the bowtie2 index files and the bowtie2 options, so changing
+# either starts a fresh set of entries.
+#
+# Entries hold only the alignment attributes used by process_target_sam;
+# the seq and qual come from the read itself. When the cache grows beyond
+# max_entries the least recently used entries are dropped.
+#
+
+import os
+import glob
+import sqlite3
+from hashlib import sha1, md5
+from bio_file_parsers import fastq_block_parser, SeqWriter
+from seq_utils import AlignmentRecord, reverse_complement
+from pool_utils import read_chunks
+
+# Default number of entries kept and the number of reads looked up at a time
+# (kept below sqlite's limit of 999 query parameters)
+MAX_ENTRIES = 10000000
+LOOKUP_SIZE = 500
+
+COLUMNS = ['j_flag', 'j_tid', 'j_pos', 'j_qstart', 'v_flag', 'v_tid', 'v_qend', 'v_aend']
+
+class AlignmentCache:
+    """ Alignment results for reads aligned against index_prefixes (J then V)
+        with bowtie2 options opts. Use split_fastq to write the reads that
+        need aligning, then merge_pairs to get alignments for every read.
+    """
+
+    def __init__(self, db_file, index_prefixes, opts, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.context = index_checksum(index_prefixes) + '\t' + opts
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+        self.conn = sqlite3.connect(db_file)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS alignments '
+                          '(key TEXT PRIMARY KEY, {0}, last_used INTEGER)'.format(', '.join(COLUMNS)))
+        self.conn.execute('CREATE INDEX IF NOT EXISTS last_used_idx ON alignments (last_used)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS runs (run INTEGER PRIMARY KEY)')
+
+        # Number this run, for least recently used eviction
+        self.run = self.conn.execute('INSERT INTO runs VALUES (NULL)').lastrowid
+        self.conn.commit()
+
+    def key(self, seq):
+        return sha1(self.context + '\t' + seq).hexdigest()
+
+    def _lookup(self, keys):
+        """ Returns a dict of key: row for the keys in the cache, and marks
+            them as used in this run.
+        """
+        found = {}
+        query = 'SELECT key, {0} FROM alignments WHERE key IN ({1})'.format(
+            ', '.join(COLUMNS), ', '.join(['?'] * len(keys)))
+        for row in self.conn.execute(query, keys):
+            found[row[0]] = row[1:]
+        if found:
+            self.conn.execute('UPDATE alignments SET last_used = ? WHERE key IN ({0})'.format(
+                ', '.join(['?'] * len(found))), [self.run] + found.keys())
+        return found
+
+    def split_fastq(self, in_fastq, miss_fastq):
+        """ Writes the reads in in_fastq with no cached alignment to
+            miss_fastq. Returns the number of reads written.
+        """
+        num_misses = 0
+        with open(in_fastq, 'r') as in_handle:
+            with open(miss_fastq, 'w') as out_handle:
+                with SeqWriter(out_handle, 'fastq') as writer:
+                    for chunk in read_chunks(fastq_block_parser(in_handle), LOOKUP_SIZE):
+                        keys = [self.key(seq) for _, seq, _ in chunk]
+                        found = self._lookup(keys)
+                        for (title, seq, qual), key in zip(chunk, keys):
+                            if key not in found:
+                                writer.write(title, seq, qual)
+                                num_misses += 1
+        self.conn.commit()
+        return num_misses
+
+    def merge_pairs(self, in_fastq, sam_pairs):
+        """ Yields a (J, V) alignment pair for every read in in_fastq, in
+            order. Cached reads get AlignmentRecords built from the cache and
+            the others take the next pair from sam_pairs, the alignments of
+            the reads written by split_fastq, which are added to the cache.
+        """
+        with open(in_fastq, 'r') as in_handle:
+            for chunk in read_chunks(fastq_block_parser(in_handle), LOOKUP_SIZE):
+                keys = [self.key(seq) for _, seq, _ in chunk]
+                found = self._lookup(keys)
+                new_rows = []
+                for (title, seq, qual), key in zip(chunk, keys):
+                    row = found.get(key)
+                    if row is not None:
+                        self.hits += 1
+                        yield cached_pair(title, seq, qual, row)
+                        continue
+                    self.misses += 1
+                    pair = next(sam_pairs, None)
+                    if pair is None or pair[0].qname != title:
+                        raise ValueError('Alignments are out of step with reads at {0}'.format(title))
+                    new_rows.append((key,) + pair_row(*pair) + (self.run,))
+                    yield pair
+                self.conn.executemany('INSERT OR REPLACE INTO alignments VALUES ({0})'.format(
+                    ', '.join(['?'] * (len(COLUMNS) + 2))), new_rows)
+                self.conn.commit()
+
+    def evict(self):
+        """ Drops the least recently used entries beyond max_entries.
+        """
+        num_entries = self.conn.execute('SELECT COUNT(*) FROM alignments').fetchone()[0]
+        excess = num_entries - self.max_entries
+        if excess > 0:
+            self.conn.execute('DELETE FROM alignments WHERE key IN (SELECT key FROM alignments '
+                              'ORDER BY last_used, rowid LIMIT ?)', (excess,))
+            self.conn.commit()
+            self.evicted += excess
+
+    def stats(self):
+        """ Returns log file lines with the hit rate of this run.
+        """
+        total = self.hits + self.misses
+        hit_rate = float(self.hits) / total if total else 0.0
+        return ['Alignment cache hits:\t{0}'.format(self.hits),
+                'Alignment cache misses:\t{0}'.format(self.misses),
+                'Alignment cache hit rate:\t{0:.3f}'.format(hit_rate),
+                'Alignment cache entries evicted:\t{0}'.format(self.evicted)]
+
+    def close(self):
+        self.evict()
+        self.conn.close()
+
+def cached_pair(title, seq, qual, row):
+    """ Returns J and V AlignmentRecords for a read from a cache row. As in a
+        SAM, the seq and qual of reverse strand alignments are reversed (and
+        the seq complemented).
+    """
+    j_flag, j_tid, j_pos, j_qstart, v_flag, v_tid, v_qend, v_aend = row
+    records = []
+    for flag, tid, pos, qstart, qend, aend in [(j_flag, j_tid, j_pos, j_qstart, None, None),
+                                               (v_flag, v_tid, None, None, v_qend, v_aend)]:
+        is_reverse = bool(flag & 16)
+        if is_reverse:
+            sam_seq, sam_qual = reverse_complement(seq), qual[::-1]
+        else:
+            sam_seq, sam_qual = seq, qual
+        records.append(AlignmentRecord(title, bool(flag & 4), is_reverse, tid, pos, qstart,
+                                       qend, aend, sam_seq, sam_qual))
+    return records[0], records[1]
+
+def pair_row(j_align, v_align):
+    """ Returns the cache columns for a J/V alignment pair.
+    """
+    j_flag = 4 * j_align.is_unmapped + 16 * j_align.is_reverse
+    v_flag = 4 * v_align.is_unmapped + 16 * v_align.is_reverse
+    return (j_flag, j_align.rname, j_align.pos, j_align.qstart,
+            v_flag, v_align.rname, v_align.qend, v_align.aend)
+
+def index_checksum(index_prefixes):
+    """ Returns an md5 of the names and contents of the bowtie2 index files
+        for each index prefix.
+    """
+    checksum = md5()
+    for index_prefix in index_prefixes:
+        files = sorted(glob.glob(index_prefix + '.*.bt2') + glob.glob(index_prefix + '.*.bt2l'))
+        for index_file in files:
+            checksum.update(os.path.basename(index_file))
+            with open(index_file, 'rb') as in_handle:
+                for block in iter(lambda: in_handle.read(1024 ** 2), ''):
+                    checksum.update(block)
+    return checksum.hexdigest()
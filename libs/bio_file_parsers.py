@@ -7,7 +7,14 @@
 #
 
 from xml.etree.ElementTree import ElementTree
-from math import ceil # To round up line wrap
+
+# Bytes read at a time by fastq_block_parser and records per batch yielded by
+# fastq_batch_parser
+BLOCK_SIZE = 4 * 1024 ** 2
+BATCH_SIZE = 10000
+
+# Bytes buffered by SeqWriter before writing to the handle
+WRITE_BUFFER_SIZE = 1024 ** 2
 
 def wrap(string, length):
     """ Yield successive length-sized chunks from string.
@@ -31,27 +38,86 @@ def phred_score_dict(offset):
 def write_fasta(handle, header, seq, max_line=79):
     """ Will write the fasta sequence to the handle.
     """
-    
-    # Calculate how many columns per line
-    num_lines = int(len(seq) / max_line) + 1
-    len_line = int(ceil(float(len(seq))/num_lines))
-    
-    # Write header
-    handle.write('>')
-    handle.write(header)
-    handle.write('\n')
-    
-    # Write wrapped lines
-    if len(seq) > 0:
-        for seq_part in wrap(seq, len_line):
-            handle.write(seq_part)
-            handle.write('\n')
-    else:
-        handle.write(seq)
-        handle.write('\n')
+    handle.write(format_fasta(header, seq, max_line))
         
     return 0
 
+def format_fasta(header, seq, max_line=79):
+    """ Returns a fasta record as a string. Lines are wrapped evenly so that
+        none are longer than max_line, or not at all if max_line is None.
+    """
+    seq_len = len(seq)
+    if not max_line or seq_len < max_line:
+        return '>' + header + '\n' + seq + '\n'
+
+    # Calculate how many columns per line
+    num_lines = seq_len // max_line + 1
+    len_line = (seq_len + num_lines - 1) // num_lines
+
+    lines = [seq[i:i + len_line] for i in xrange(0, seq_len, len_line)]
+
+    return '>' + header + '\n' + '\n'.join(lines) + '\n'
+
+def format_fastq(header, seq, qual):
+    """ Returns a 4 line fastq record as a string.
+    """
+    return '@' + header + '\n' + seq + '\n+\n' + qual + '\n'
+
+class SeqWriter:
+    """ Buffered fasta/fastq writer. Records are formatted into a buffer which
+        is written to the handle in large blocks, rather than making several
+        handle.write calls per record. Fasta output is wrapped the same way as
+        write_fasta unless max_line is None. Also counts the records and bytes
+        written.
+    """
+
+    def __init__(self, handle, fmt='fasta', max_line=79, buffer_size=WRITE_BUFFER_SIZE):
+        self.handle = handle
+        self.fmt = fmt
+        self.max_line = max_line
+        self.buffer_size = buffer_size
+        self.count = 0
+        self.bytes_written = 0
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, header, seq, qual=None):
+        if self.fmt == 'fastq':
+            record = format_fastq(header, seq, qual)
+        else:
+            record = format_fasta(header, seq, self.max_line)
+        self._buffer.append(record)
+        self._buffered += len(record)
+        self.count += 1
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def write_records(self, records):
+        """ Writes an iterable of (header, seq) or (header, seq, qual).
+        """
+        write = self.write
+        for record in records:
+            write(*record)
+
+    def flush(self):
+        if self._buffer:
+            self.handle.write(''.join(self._buffer))
+            self.bytes_written += self._buffered
+            self._buffer = []
+            self._buffered = 0
+
+    def close(self):
+        """ Flushes the buffer and closes the handle.
+        """
+        self.flush()
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
 def blast_xml_parser(xml_handle):
     """ Will parse the BLAST xml output file and for each query yield a dict
         containing the following values:
@@ -226,6 +292,162 @@ def fastq_parser(handle):
         yield (title_line, seq_string, quality_string)
     raise StopIteration
 
+def fastq_block_parser(handle, strict=True, block_size=BLOCK_SIZE):
+    """ High throughput version of fastq_parser. The handle is read in large
+        blocks and records are split out of the buffer with str.find instead
+        of calling readline for every line. Yields (title, seq, qual) tuples
+        and supports the same multi-line records as fastq_parser.
+
+        With strict=False the input is trusted: the '+' line caption and
+        sequence whitespace checks are skipped and the lines of ordinary 4 line
+        records are not rstripped, so the file must have Unix line endings.
+    """
+    read = handle.read
+    find = str.find
+    buf = ''
+    pos = 0
+    at_eof = False
+    started = False
+
+    while True:
+        # Find the ends of the next 4 lines
+        n4 = -1
+        n1 = find(buf, '\n', pos)
+        if n1 != -1:
+            n2 = find(buf, '\n', n1 + 1)
+            if n2 != -1:
+                n3 = find(buf, '\n', n2 + 1)
+                if n3 != -1:
+                    n4 = find(buf, '\n', n3 + 1)
+
+        # Read another block if a whole record might not be buffered
+        if n4 == -1 and not at_eof:
+            buf, pos, at_eof = _refill_buffer(buf, pos, read, block_size)
+            continue
+        if n1 == -1:
+            return
+
+        # Skip any text before the first record and blank lines between them
+        if buf[pos] != '@':
+            if started and buf[pos:n1].strip():
+                raise ValueError(
+                    "Records in Fastq files should start with '@' character")
+            pos = n1 + 1
+            continue
+        started = True
+
+        # Standard 4 line record with no wrapping
+        if n4 != -1 and buf[n2 + 1] == '+' and n4 - n3 == n2 - n1:
+            if not strict:
+                yield buf[pos + 1:n1], buf[n1 + 1:n2], buf[n3 + 1:n4]
+                pos = n4 + 1
+                continue
+            title_line = buf[pos + 1:n1].rstrip()
+            seq_string = buf[n1 + 1:n2].rstrip()
+            second_title = buf[n2 + 2:n3].rstrip()
+            quality_string = buf[n3 + 1:n4].rstrip()
+            if second_title and second_title != title_line:
+                raise ValueError("Sequence and quality captions differ.")
+            if " " in seq_string or "\t" in seq_string:
+                raise ValueError("Whitespace is not allowed in the sequence.")
+            if len(seq_string) != len(quality_string):
+                raise ValueError("Lengths of sequence and quality values differs "
+                                 " for %s (%i and %i)."
+                                 % (title_line, len(seq_string), len(quality_string)))
+            yield title_line, seq_string, quality_string
+            pos = n4 + 1
+            continue
+
+        # Otherwise parse it line by line, reading more if needed
+        record = _fastq_multiline_record(buf, pos, at_eof)
+        if record is None:
+            buf, pos, at_eof = _refill_buffer(buf, pos, read, block_size)
+            continue
+        title_line, seq_string, quality_string, pos = record
+        if strict and (" " in seq_string or "\t" in seq_string):
+            raise ValueError("Whitespace is not allowed in the sequence.")
+        yield title_line, seq_string, quality_string
+
+def fastq_batch_parser(handle, batch_size=BATCH_SIZE, strict=True, block_size=BLOCK_SIZE):
+    """ Yields lists of up to batch_size (title, seq, qual) tuples from
+        fastq_block_parser.
+    """
+    batch = []
+    for record in fastq_block_parser(handle, strict, block_size):
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _refill_buffer(buf, pos, read, block_size):
+    """ Drops the parsed part of buf and appends the next block. At the end of
+        the file a final newline is added if missing. Returns the new buf, pos
+        and whether the end of the file has been reached.
+    """
+    block = read(block_size)
+    buf = buf[pos:] + block
+    if block:
+        return buf, 0, False
+    if buf and buf[-1] != '\n':
+        buf += '\n'
+    return buf, 0, True
+
+def _fastq_multiline_record(buf, pos, at_eof):
+    """ Parses a record that may have wrapped seq and qual lines, starting at
+        the '@' line at pos, using the same rules as fastq_parser. Returns
+        (title, seq, qual, next pos), or None if buf doesn't hold the whole
+        record yet.
+    """
+    end = buf.find('\n', pos)
+    title_line = buf[pos + 1:end].rstrip()
+    pos = end + 1
+
+    # Sequence lines up to the '+' line
+    seq_lines = []
+    while True:
+        end = buf.find('\n', pos)
+        if end == -1:
+            if at_eof:
+                raise ValueError("End of file without quality information.")
+            return None
+        line = buf[pos:end]
+        pos = end + 1
+        if line[:1] == "+":
+            second_title = line[1:].rstrip()
+            if second_title and second_title != title_line:
+                raise ValueError("Sequence and quality captions differ.")
+            break
+        seq_lines.append(line.rstrip())
+    seq_string = "".join(seq_lines)
+    seq_len = len(seq_string)
+
+    # Quality lines until the next '@' line once there is enough quality
+    qual_lines = []
+    qual_len = 0
+    while True:
+        end = buf.find('\n', pos)
+        if end == -1:
+            if at_eof:
+                break
+            return None
+        line = buf[pos:end]
+        if qual_lines and line[:1] == "@" and qual_len >= seq_len:
+            break
+        line = line.rstrip()
+        qual_lines.append(line)
+        qual_len += len(line)
+        pos = end + 1
+    quality_string = "".join(qual_lines)
+
+    if seq_len != len(quality_string):
+        raise ValueError("Lengths of sequence and quality values differs "
+                         " for %s (%i and %i)."
+                         % (title_line, seq_len, len(quality_string)))
+
+    return title_line, seq_string, quality_string, pos
+
 def clstr_parser(handle):
     """ Parses a cd-hit-est clstr file. Very similar to parsing a fasta file.
     """
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Runs several bowtie2 alignments of the same reads at the same time,
+# splitting the available CPUs between them in proportion to the size of
+# each index, as a run against a small index finishes much sooner than one
+# against a large index given the same number of threads.
+#
+# An alignment can also write its SAM to a pipe instead of a file, so that
+# it can be read as it is produced (see sam_stream.SamStream).
+#
+
+import os
+import glob
+import subprocess
+
+BOWTIE_OPTS = '--very-sensitive-local --reorder'
+
+def run_alignments(bowtie_exe, in_fastq, jobs, num_cpu, opts=BOWTIE_OPTS):
+    """ Aligns in_fastq against each (index_prefix, out_sam) in jobs
+        concurrently, splitting num_cpu threads between them by index size.
+        Waits for every alignment to finish and returns a list of
+        (command, return code) in the same order as jobs.
+    """
+    procs = start_alignments(bowtie_exe, in_fastq, jobs, num_cpu, opts)
+    return wait_alignments(procs)
+
+def start_alignments(bowtie_exe, in_fastq, jobs, num_cpu, opts=BOWTIE_OPTS):
+    """ Starts the alignments for run_alignments without waiting on them.
+        If out_sam is None for a job the SAM is written to a pipe, which can
+        be read from the stdout of its process. Returns a list of
+        (command, Popen) in the same order as jobs.
+    """
+    threads = split_cpus(num_cpu, [index_size(index) for index, _ in jobs])
+
+    procs = []
+    for (index, out_sam), job_cpu in zip(jobs, threads):
+        cmd = '{0} {1} -x {2} -U {3} -p {4}'.format(bowtie_exe, opts, index,
+                                                    in_fastq, job_cpu)
+        if out_sam is None:
+            proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+        else:
+            cmd += ' -S {0}'.format(out_sam)
+            proc = subprocess.Popen(cmd, shell=True)
+        procs.append((cmd, proc))
+
+    return procs
+
+def wait_alignments(procs):
+    """ Waits on every (command, Popen) from start_alignments, even if
+        one fails, and returns a list of (command, return code).
+    """
+    return [(cmd, proc.wait()) for cmd, proc in procs]
+
+def split_cpus(num_cpu, weights):
+    """ Splits num_cpu between jobs in proportion to weights, giving every job
+        at least 1. Leftover CPUs go to the jobs with the largest remainders.
+        If there are more jobs than CPUs each job gets 1.
+    """
+    num_jobs = len(weights)
+    if num_cpu <= num_jobs:
+        return [1] * num_jobs
+
+    # Jobs with no weight (e.g. a missing index) are treated equally
+    total = float(sum(weights))
+    if total <= 0:
+        weights = [1] * num_jobs
+        total = float(num_jobs)
+
+    # Give the 1 CPU minimum, then share the rest by weight
+    spare = num_cpu - num_jobs
+    shares = [spare * w / total for w in weights]
+    split = [1 + int(x) for x in shares]
+    by_remainder = sorted(range(num_jobs), key=lambda i: shares[i] - int(shares[i]), reverse=True)
+    for i in by_remainder[:num_cpu - sum(split)]:
+        split[i] += 1
+
+    return split
+
+def index_size(index_prefix):
+    """ Returns the total size in bytes of the bowtie2 index files for
+        index_prefix (0 if there are none).
+    """
+    files = glob.glob(index_prefix + '.*.bt2') + glob.glob(index_prefix + '.*.bt2l')
+    return sum([os.path.getsize(x) for x in files])
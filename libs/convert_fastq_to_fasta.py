@@ -7,7 +7,7 @@
 #
 
 import sys
-from bio_file_parsers import write_fasta, fastq_parser
+from bio_file_parsers import SeqWriter, fastq_parser
 
 
 def main():
@@ -16,12 +16,16 @@ def main():
     
     return 0
 
-def convert_fastq_to_fasta(fastq_in, fasta_out):
+def convert_fastq_to_fasta(fastq_in, fasta_out, max_line=79):
+    """ Writes the fastq records as fasta, wrapped at max_line (or not at all
+        if max_line is None).
+    """
     
     with open(fastq_in, 'r') as in_h:
         with open(fasta_out, 'w') as out_h:
-            for title, seq, _ in fastq_parser(in_h):
-                write_fasta(out_h, title, seq)
+            with SeqWriter(out_h, max_line=max_line) as writer:
+                for title, seq, _ in fastq_parser(in_h):
+                    writer.write(title, seq)
 
 if __name__ == '__main__':
     
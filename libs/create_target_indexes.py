@@ -1,11 +1,21 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 #
+# Builds the bowtie2 index of the diagnostic targets for a follow-up run.
+# If a cache directory is given, built indexes are kept there in a
+# directory named by a sha1 of the target names and sequences, so later
+# follow-ups with the same targets copy the index rather than running
+# bowtie2-build. The least recently used entries are removed once the
+# cache is bigger than max_cache_bytes.
+#
 
 import os
 import sys
+import glob
+import shutil
 import subprocess
-from bio_file_parsers import fasta_parser, write_fasta
+from hashlib import sha1
+from bio_file_parsers import fasta_parser, SeqWriter
 import re
 import pandas as pd
 
@@ -15,7 +25,11 @@ def main(args):
     
     return 0
 
-def make_indexes(cluster_fasta, out_prefix, threshold):
+# Default size limit of the index cache
+MAX_CACHE_BYTES = 2 * 1024 ** 3
+
+def make_indexes(cluster_fasta, out_prefix, threshold, cache_dir=None,
+                 max_cache_bytes=MAX_CACHE_BYTES):
     
     bowtie_build = './libs/bowtie2-2.2.1/bowtie2-build'
     
@@ -25,16 +39,101 @@ def make_indexes(cluster_fasta, out_prefix, threshold):
     # Write fasta
     fasta_name = '{0}.fasta'.format(out_prefix)
     with open(fasta_name, 'w') as out_handle:
-        for idx in target_df.index:
-            write_fasta(out_handle, target_df.loc[idx, 'name'],
-                        target_df.loc[idx, 'seq'])
+        with SeqWriter(out_handle) as writer:
+            for idx in target_df.index:
+                writer.write(target_df.loc[idx, 'name'],
+                             target_df.loc[idx, 'seq'])
+    
+    # Use a cached index of the same targets if there is one
+    entry_dir = None
+    if cache_dir is not None:
+        entry_dir = os.path.join(cache_dir, targets_key(target_df))
+        if fetch_cached_index(entry_dir, out_prefix):
+            print 'Using cached bowtie2 index {0}'.format(entry_dir)
+            return list(target_df['name'])
     
     # Run bowtie2-build
     cmd = '{0} {1} {2}'.format(bowtie_build, fasta_name, out_prefix)
-    subprocess.call(cmd, shell=True)
+    return_code = subprocess.call(cmd, shell=True)
+    
+    if entry_dir is not None and return_code == 0:
+        store_cached_index(entry_dir, out_prefix)
+        evict_cached_indexes(cache_dir, max_cache_bytes, keep=entry_dir)
     
     return list(target_df['name'])
 
+def targets_key(target_df):
+    """ Returns a sha1 of the names and seqs of the targets, in order.
+    """
+    checksum = sha1()
+    for idx in target_df.index:
+        checksum.update(target_df.loc[idx, 'name'] + '\t')
+        checksum.update(target_df.loc[idx, 'seq'] + '\n')
+    return checksum.hexdigest()
+
+def index_files(prefix):
+    """ Returns the bowtie2 index files with prefix.
+    """
+    return sorted(glob.glob(prefix + '.*.bt2') + glob.glob(prefix + '.*.bt2l'))
+
+def fetch_cached_index(entry_dir, out_prefix):
+    """ Copies the index in entry_dir to out_prefix, if it has one. Returns
+        True if it was copied.
+    """
+    if not os.path.isdir(entry_dir):
+        return False
+    cached_files = index_files(os.path.join(entry_dir, 'index'))
+    if not cached_files:
+        return False
+    for cached_file in cached_files:
+        suffix = os.path.basename(cached_file)[len('index'):]
+        shutil.copyfile(cached_file, out_prefix + suffix)
+    # Mark the entry as recently used
+    os.utime(entry_dir, None)
+    return True
+
+def store_cached_index(entry_dir, out_prefix):
+    """ Copies the index at out_prefix into entry_dir. The files are copied
+        to a temporary directory first, which is renamed into place, so an
+        interrupted copy is never used.
+    """
+    cache_dir = os.path.dirname(entry_dir)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    tmp_dir = '{0}.tmp{1}'.format(entry_dir, os.getpid())
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.mkdir(tmp_dir)
+    for index_file in index_files(out_prefix):
+        suffix = os.path.basename(index_file)[len(os.path.basename(out_prefix)):]
+        shutil.copyfile(index_file, os.path.join(tmp_dir, 'index' + suffix))
+    if os.path.exists(entry_dir):
+        shutil.rmtree(entry_dir)
+    os.rename(tmp_dir, entry_dir)
+
+def evict_cached_indexes(cache_dir, max_cache_bytes, keep=None):
+    """ Removes the least recently used entries of cache_dir until it is no
+        bigger than max_cache_bytes. The keep entry is never removed.
+    """
+    entries = []
+    total_bytes = 0
+    for name in os.listdir(cache_dir):
+        entry_dir = os.path.join(cache_dir, name)
+        if not os.path.isdir(entry_dir) or '.tmp' in name:
+            continue
+        size = sum([os.path.getsize(os.path.join(entry_dir, x)) for x in os.listdir(entry_dir)])
+        entries.append((os.path.getmtime(entry_dir), entry_dir, size))
+        total_bytes += size
+    
+    # Oldest first
+    for _, entry_dir, size in sorted(entries):
+        if total_bytes <= max_cache_bytes:
+            break
+        if entry_dir == keep:
+            continue
+        shutil.rmtree(entry_dir)
+        total_bytes -= size
+
 def get_target_seqs(clusters_file, threshold):
     """ Takes the fasta file containing clusters from the first stage
         and makes a bowtie2 index for clusters above specified proportion.
@@ -2,33 +2,42 @@
 
 import sys
 from libs.bio_file_parsers import fasta_parser
-from libs.bio_file_parsers import write_fasta
+from libs.bio_file_parsers import SeqWriter
+from libs.seq_keys import pack_seq, unpack_seq
 
 def main(args):
     
     derep_fasta(open(args['in'], args['out']))
 
 
-def derep_fasta(in_file, out_file):
+def derep_fasta(in_file, out_file, packed_keys=False):
+    """ Dereplicates a fasta with ;size= annotations, writing records in
+        decreasing size order. If packed_keys is True the sequences are stored
+        as 2-bit packed keys (see seq_keys.pack_seq).
+    """
     
     seqs = {}
     dup = 0
     
     for record in fasta_parser(open(in_file, 'r')):
         size = int(record[0].split(';size=')[1])
-        if record[1] not in seqs:
-            seqs[record[1]] = {'title':record[0],
-                               'size':size}
+        key = record[1]
+        if packed_keys:
+            key = pack_seq(key)
+        if key not in seqs:
+            seqs[key] = {'title':record[0],
+                         'size':size}
         else:
-            seqs[record[1]]['size'] += size
+            seqs[key]['size'] += size
             dup += 1
     
     with open(out_file, 'w') as out_handle:
-        for key in sorted(seqs.keys(), key=lambda x: seqs[x]['size'], reverse=True):
-            title = seqs[key]['title'].split(';size=')[0]
-            size = seqs[key]['size']
-            title = '{0};size={1}'.format(title, size)
-            write_fasta(out_handle, title, key)
+        with SeqWriter(out_handle) as writer:
+            for key in sorted(seqs.keys(), key=lambda x: seqs[x]['size'], reverse=True):
+                title = seqs[key]['title'].split(';size=')[0]
+                size = seqs[key]['size']
+                title = '{0};size={1}'.format(title, size)
+                writer.write(title, unpack_seq(key))
     
     #~ print len(seqs)
     #~ print len(seqs) + dup
@@ -1,92 +1,465 @@
+
 # pypy script <in_fastq> <out_fastq>
 
+import os
 import sys
-import gzip
-from libs.bio_file_parsers import fastq_parser, phred_score_dict
+import zlib
+import heapq
+import tempfile
+from math import ceil
+from shutil import rmtree
+from multiprocessing import Process, Queue
+from libs.bio_file_parsers import fastq_block_parser, SeqWriter
+from libs.seq_keys import pack_seq, unpack_seq
+from libs.quality_stats import mean_phred_scores
+from libs.gzip_reader import open_reads
 #~ from bio_file_parsers import fastq_parser, phred_score_dict
 from operator import itemgetter
+from itertools import izip
+
+# Once the best qual strings held in memory exceed this many bytes, single
+# pass mode drops them and falls back to re-reading the input
+MAX_QUAL_BYTES = 2 * 1024 ** 3
+
+# Rough bytes of python objects held per byte of (uncompressed) fastq when
+# every read is unique, used to decide how many shards to spill to disk
+TABLE_OVERHEAD = 3
+GZIP_RATIO = 4
+
+# Most shard files the external mode has open at once. With more shards
+# the input is partitioned, and the shard results merged, in several passes
+MAX_OPEN_SHARDS = 256
+
+# Number of records sent to a parallel derep worker (or having their mean
+# quality calculated) at a time and the number of chunks that can be queued
+# up for each worker
+CHUNK_SIZE = 10000
+QUEUE_CHUNKS = 8
 
 def main(args):
 
     derep_fastq(args['in'], args['out'])
 
-def derep_fastq(in_file, out_file):
+def derep_fastq(in_file, out_file, single_pass=True, max_qual_bytes=MAX_QUAL_BYTES,
+                mem_budget=None, num_cpu=1, packed_keys=False, out_fasta=None):
+    """ Dereplicates the reads in in_file and writes the best quality record
+        for each unique sequence to out_file with a ;size= annotation.
 
-    phred_dict = phred_score_dict(33)
+        In single pass mode the qual string of the best record is kept with
+        its count so the output can be written straight from memory. If the
+        stored qual strings grow beyond max_qual_bytes they are discarded and
+        the input is parsed a second time instead.
 
+        If mem_budget (bytes) is given then the external memory mode is used
+        instead, see derep_fastq_external. Its memory is bounded by
+        mem_budget rather than max_qual_bytes, and it can't be combined with
+        single_pass=False. If num_cpu is more than 1 the parallel engine is
+        used, see derep_fastq_parallel.
 
-    # Open correct handle for file compression
-    if in_file.split('.')[-1] == 'gz':
-        in_handle = gzip.open(in_file, 'r')
-    else:
-        in_handle = open(in_file, 'r')
+        If packed_keys is True the table is keyed on 2-bit packed sequences
+        (see seq_keys.pack_seq) to reduce memory per unique read.
+
+        If out_fasta is given the records are also written there as fasta in
+        the same pass, saving a separate fastq to fasta conversion.
+    """
+    if mem_budget is not None:
+        if not single_pass:
+            raise ValueError('The external memory mode always holds qual strings, '
+                             'single_pass=False is not supported with mem_budget')
+        return derep_fastq_external(in_file, out_file, mem_budget, out_fasta=out_fasta,
+                                    packed_keys=packed_keys)
+    if num_cpu > 1:
+        return derep_fastq_parallel(in_file, out_file, num_cpu, out_fasta=out_fasta,
+                                    single_pass=single_pass, max_qual_bytes=max_qual_bytes,
+                                    packed_keys=packed_keys)
+
+    in_handle = open_handle(in_file)
 
+    # seq: [header, ave_qual, size, record index, qual]
     seqs = {}
     total_reads = 0
     dup = 0
+    qual_bytes = 0
 
     # Save records to a dictionary, using the seq as a key
-    for q_header, q_seq, q_qual in fastq_parser(in_handle):
+    for q_header, q_seq, q_qual, q_ave_qual in add_mean_quals(fastq_block_parser(in_handle)):
 
         total_reads += 1
 
-        # Get seq size if present
-        parts = q_header.split(';size=')
-        q_header = parts[0]
-        if len(parts) > 1:
-            size = int(parts[1])
+        # Only hold on to the qual string in single pass mode
+        if not single_pass:
+            q_qual_kept = None
         else:
-            size = 1
+            q_qual_kept = q_qual
 
-        # Calc average quality
-        q_ave_qual = average_phred_score(q_qual, phred_dict)
+        if packed_keys:
+            q_seq = pack_seq(q_seq)
 
-        # Check if seq exists
-        if q_seq not in seqs:
-            seqs[q_seq] = [q_header, q_ave_qual, size]
+        if add_record(seqs, total_reads, q_header, q_seq, q_ave_qual, q_qual_kept):
+            if single_pass:
+                qual_bytes += len(q_qual)
         else:
             dup += 1
-            # Add 1 to the count
-            seqs[q_seq][2] += size
-            # If the quality is higher then replace
-            if q_ave_qual > seqs[q_seq][1]:
-                seqs[q_seq][0] = q_header
-                seqs[q_seq][1] = q_ave_qual
+
+        # Fall back to two pass mode if the table is getting too big
+        if single_pass and qual_bytes > max_qual_bytes:
+            for seq in seqs:
+                seqs[seq][4] = None
+            single_pass = False
 
     in_handle.close()
 
+    if single_pass:
+        # Write records in the order their best read appeared in the input
+        records = sorted(seqs.iteritems(), key=lambda x: x[1][3])
+        write_derep_records(out_file,
+                            ((header, size, unpack_seq(seq), qual)
+                             for seq, (header, _, size, _, qual) in records),
+                            out_fasta)
+        return 0
+
     # Make a dict of the uniqe reads headers and their cluster sizes
     to_keep = {}
     for seq in seqs:
         to_keep[seqs[seq][0]] = seqs[seq][2]
+    seqs = None
 
     #~ print to_keep
     ### Iterate over the fastq again and keep unique records ##
+    in_handle = open_handle(in_file)
 
-    # Open correct handle for file compression
-    if in_file.split('.')[-1] == 'gz':
-        in_handle = gzip.open(in_file, 'r')
+    # Write new fastq
+    write_derep_records(out_file, kept_records(fastq_block_parser(in_handle), to_keep), out_fasta)
+    in_handle.close()
+
+    return 0
+
+def kept_records(records, to_keep):
+    """ Yields (header, size, seq, qual) for the records whose header is in
+        to_keep, with the size taken from to_keep.
+    """
+    for header, seq, qual in records:
+        header = header.split(';size=')[0]
+        if not header in to_keep:
+            continue
+        yield header, to_keep[header], seq, qual
+
+def add_record(seqs, index, q_header, q_seq, q_ave_qual, q_qual):
+    """ Adds a fastq record with average quality q_ave_qual to the
+        dereplication table. The size is taken from the header if present.
+        The record replaces the stored one only if its average quality is
+        strictly higher, so the earliest read wins ties. Returns True if the
+        seq was not already in the table.
+    """
+    # Get seq size if present
+    parts = q_header.split(';size=')
+    q_header = parts[0]
+    if len(parts) > 1:
+        size = int(parts[1])
     else:
-        in_handle = open(in_file, 'r')
+        size = 1
 
-    # Write new fastq
-    with open(out_file, 'w') as out_handle:
-        for header, seq, qual in fastq_parser(in_handle):
-            header = header.split(';size=')[0]
-            if not header in to_keep:
-                continue
-            title = header.split(' ')[0]
-            title = '@{0};size={1}'.format(title, to_keep[header])
-            entry = [title, seq, '+', qual]
-            out_handle.write('\n'.join(entry) + '\n')
+    # Check if seq exists
+    if q_seq not in seqs:
+        seqs[q_seq] = [q_header, q_ave_qual, size, index, q_qual]
+        return True
+
+    entry = seqs[q_seq]
+    # Add 1 to the count
+    entry[2] += size
+    # If the quality is higher then replace
+    if q_ave_qual > entry[1]:
+        entry[0] = q_header
+        entry[1] = q_ave_qual
+        entry[3] = index
+        entry[4] = q_qual
+    return False
+
+def add_mean_quals(records, chunk_size=CHUNK_SIZE):
+    """ Yields each record tuple with the average phred score of its qual
+        string (the last item) appended. Scores are calculated a chunk of
+        records at a time by quality_stats.mean_phred_scores.
+    """
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            for record, ave_qual in izip(chunk, mean_phred_scores([x[-1] for x in chunk])):
+                yield record + (ave_qual,)
+            chunk = []
+    for record, ave_qual in izip(chunk, mean_phred_scores([x[-1] for x in chunk])):
+        yield record + (ave_qual,)
+
+def derep_fastq_external(in_file, out_file, mem_budget, num_shards=None, tmp_dir=None,
+                         out_fasta=None, packed_keys=False):
+    """ External memory dereplication. Reads are hash partitioned by sequence
+        into num_shards files on disk so that identical reads always share a
+        shard. Each shard is then dereplicated on its own and the results are
+        merged back into input order. The output is identical to derep_fastq.
+
+        If num_shards is not given it is estimated from the input size so
+        that a single shard's table fits in mem_budget bytes. The input is
+        read once for every MAX_OPEN_SHARDS shards. If packed_keys is True
+        each shard's table is keyed on packed seqs.
+    """
+
+    if num_shards is None:
+        num_shards = estimate_num_shards(in_file, mem_budget)
+    if tmp_dir is None:
+        tmp_dir = os.path.dirname(os.path.abspath(out_file))
+    shard_dir = tempfile.mkdtemp(prefix='derep_shards_', dir=tmp_dir)
+
+    try:
+        # Partition reads into shards, tagging each with its input position
+        shard_files = [os.path.join(shard_dir, 'shard_{0}.tsv'.format(i)) for i in range(num_shards)]
+        for first in range(0, num_shards, MAX_OPEN_SHARDS):
+            partition_reads(in_file, shard_files, first, min(first + MAX_OPEN_SHARDS, num_shards))
+
+        # Dereplicate each shard separately, writing results in input order
+        result_files = []
+        for shard_file in shard_files:
+            seqs = {}
+            with open(shard_file, 'r') as in_h:
+                for index, header, seq, qual, ave_qual in add_mean_quals(shard_parser(in_h)):
+                    if packed_keys:
+                        seq = pack_seq(seq)
+                    add_record(seqs, index, header, seq, ave_qual, qual)
+            os.remove(shard_file)
+            result_file = shard_file + '.derep'
+            with open(result_file, 'w') as out_h:
+                for seq, (header, _, size, index, qual) in sorted(seqs.iteritems(), key=lambda x: x[1][3]):
+                    out_h.write(format_shard_result(index, header, size, unpack_seq(seq), qual))
+            seqs = None
+            result_files.append(result_file)
+
+        # Merge shard results back into input order
+        result_files = merge_shard_results(result_files)
+        result_handles = [open(x, 'r') for x in result_files]
+        shard_iters = [shard_result_parser(x) for x in result_handles]
+        write_derep_records(out_file, (x[1:] for x in heapq.merge(*shard_iters)), out_fasta)
+        for handle in result_handles:
+            handle.close()
+
+    finally:
+        rmtree(shard_dir)
 
     return 0
 
-def average_phred_score(qual_string, phred_dict):
-    """ Given a qual string, calculates the average phred score
+def derep_fastq_parallel(in_file, out_file, num_cpu, chunk_size=CHUNK_SIZE, out_fasta=None,
+                         single_pass=True, max_qual_bytes=MAX_QUAL_BYTES, packed_keys=False):
+    """ Parallel dereplication. This process parses the input and sends
+        chunks of records to num_cpu worker processes, partitioned by
+        sequence so that identical reads always go to the same worker. Each
+        worker keeps its own table and the results are merged back into input
+        order. The output is identical to derep_fastq.
+
+        Each worker receives its records in input order, so the earliest read
+        still wins quality ties.
+
+        As in derep_fastq, workers only hold qual strings in single pass mode
+        and drop them once they exceed their share of max_qual_bytes. If any
+        worker has dropped them the input is parsed a second time instead.
+    """
+
+    # Start workers
+    in_queues = [Queue(QUEUE_CHUNKS) for _ in range(num_cpu)]
+    out_queue = Queue()
+    workers = [Process(target=derep_worker,
+                       args=(in_queue, out_queue, single_pass, max_qual_bytes / num_cpu,
+                             packed_keys))
+               for in_queue in in_queues]
+    for worker in workers:
+        worker.start()
+
+    try:
+        # Send records to the workers in chunks, tagged with their input position
+        chunks = [[] for _ in range(num_cpu)]
+        in_handle = open_handle(in_file, num_cpu)
+        index = 0
+        for header, seq, qual in fastq_block_parser(in_handle):
+            index += 1
+            shard = seq_shard(seq, num_cpu)
+            chunks[shard].append((index, header, seq, qual))
+            if len(chunks[shard]) >= chunk_size:
+                in_queues[shard].put(chunks[shard])
+                chunks[shard] = []
+        in_handle.close()
+        for shard in range(num_cpu):
+            if chunks[shard]:
+                in_queues[shard].put(chunks[shard])
+            in_queues[shard].put(None)
+
+        # Collect each worker's table before joining so the queue doesn't block
+        results = [out_queue.get() for _ in workers]
+    except:
+        # The workers would otherwise wait on their queues forever
+        for in_queue in in_queues:
+            in_queue.cancel_join_thread()
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+        raise
+    for worker in workers:
+        worker.join()
+
+    if all([kept_quals for kept_quals, _ in results]):
+        # Merge worker results back into input order
+        write_derep_records(out_file, (x[1:] for x in heapq.merge(*[x[1] for x in results])),
+                            out_fasta)
+        return 0
+
+    # Make a dict of the uniqe reads headers and their cluster sizes and
+    # take the records from the input again
+    to_keep = {}
+    for _, records in results:
+        for _, header, size, _, _ in records:
+            to_keep[header] = size
+    results = None
+    in_handle = open_handle(in_file, num_cpu)
+    write_derep_records(out_file, kept_records(fastq_block_parser(in_handle), to_keep), out_fasta)
+    in_handle.close()
+
+    return 0
+
+def derep_worker(in_queue, out_queue, single_pass=True, max_qual_bytes=MAX_QUAL_BYTES,
+                 packed_keys=False):
+    """ Dereplicates chunks of (index, header, seq, qual) records from
+        in_queue until None is received, then puts (kept quals, records) on
+        out_queue, where records is a list of (index, header, size, seq, qual)
+        sorted by index. The qual strings are only kept, and kept quals True,
+        in single pass mode while they are within max_qual_bytes. If
+        packed_keys is True the table is keyed on packed seqs.
+    """
+    seqs = {}
+    qual_bytes = 0
+    while True:
+        chunk = in_queue.get()
+        if chunk is None:
+            break
+        ave_quals = mean_phred_scores([x[3] for x in chunk])
+        for (index, header, seq, qual), ave_qual in izip(chunk, ave_quals):
+            if not single_pass:
+                qual = None
+            if packed_keys:
+                seq = pack_seq(seq)
+            if add_record(seqs, index, header, seq, ave_qual, qual) and single_pass:
+                qual_bytes += len(qual)
+
+        # Fall back to two pass mode if the table is getting too big
+        if single_pass and qual_bytes > max_qual_bytes:
+            for seq in seqs:
+                seqs[seq][4] = None
+            single_pass = False
+
+    results = [(rec_index, rec_header, size, unpack_seq(rec_seq), rec_qual)
+               for rec_seq, (rec_header, _, size, rec_index, rec_qual) in seqs.iteritems()]
+    results.sort()
+    out_queue.put((single_pass, results))
+
+def partition_reads(in_file, shard_files, first, last):
+    """ Writes the reads of in_file that belong to shards first to last - 1
+        to their shard files, as lines of index, seq, qual and header.
+    """
+    num_shards = len(shard_files)
+    shard_handles = [open(x, 'w') for x in shard_files[first:last]]
+    in_handle = open_handle(in_file)
+    index = 0
+    for header, seq, qual in fastq_block_parser(in_handle):
+        index += 1
+        shard = seq_shard(seq, num_shards)
+        if first <= shard < last:
+            # The header goes last as it is the only field that can hold a tab
+            shard_handles[shard - first].write('\t'.join([str(index), seq, qual, header]) + '\n')
+    in_handle.close()
+    for handle in shard_handles:
+        handle.close()
+
+def merge_shard_results(result_files, max_open=MAX_OPEN_SHARDS):
+    """ Merges groups of max_open dereplicated shard files into one, until no
+        more than max_open are left. Returns the remaining file names.
+    """
+    while len(result_files) > max_open:
+        merged_files = []
+        for first in range(0, len(result_files), max_open):
+            group = result_files[first:first + max_open]
+            merged_file = group[0] + '.merged'
+            group_handles = [open(x, 'r') for x in group]
+            with open(merged_file, 'w') as out_h:
+                for record in heapq.merge(*[shard_result_parser(x) for x in group_handles]):
+                    out_h.write(format_shard_result(*record))
+            for handle in group_handles:
+                handle.close()
+            for group_file in group:
+                os.remove(group_file)
+            merged_files.append(merged_file)
+        result_files = merged_files
+    return result_files
+
+def shard_parser(handle):
+    """ Yields (index, header, seq, qual) from a shard of the input.
+    """
+    for line in handle:
+        index, seq, qual, header = line.rstrip('\n').split('\t', 3)
+        yield int(index), header, seq, qual
+
+def format_shard_result(index, header, size, seq, qual):
+    """ Returns a line of a dereplicated shard, see shard_result_parser.
+    """
+    return '\t'.join([str(index), str(size), seq, qual, header]) + '\n'
+
+def shard_result_parser(handle):
+    """ Yields (index, header, size, seq, qual) from a dereplicated shard.
+    """
+    for line in handle:
+        index, size, seq, qual, header = line.rstrip('\n').split('\t', 4)
+        yield int(index), header, int(size), seq, qual
+
+def seq_shard(seq, num_shards):
+    """ Returns the shard (or worker) number for a sequence. Uses crc32 rather
+        than hash() so the partitioning is the same in every process.
+    """
+    return (zlib.crc32(seq) & 0xffffffff) % num_shards
+
+def estimate_num_shards(in_file, mem_budget):
+    """ Estimates how many shards are needed for each shard's table to fit
+        in mem_budget bytes, assuming the worst case of every read being unique.
+    """
+    est_bytes = os.path.getsize(in_file) * TABLE_OVERHEAD
+    if in_file.split('.')[-1] == 'gz':
+        est_bytes *= GZIP_RATIO
+    return max(1, int(ceil(float(est_bytes) / mem_budget)))
+
+def write_derep_records(out_file, records, out_fasta=None):
+    """ Writes (header, size, seq, qual) records to out_file as fastq and,
+        if out_fasta is given, to out_fasta as fasta in the same pass.
+    """
+    with open(out_file, 'w') as out_handle:
+        if out_fasta is None:
+            for header, size, seq, qual in records:
+                write_derep_record(out_handle, header, size, seq, qual)
+            return
+        with open(out_fasta, 'w') as fasta_handle:
+            with SeqWriter(fasta_handle) as fasta_writer:
+                for header, size, seq, qual in records:
+                    write_derep_record(out_handle, header, size, seq, qual, fasta_writer)
+
+def write_derep_record(out_handle, header, size, seq, qual, fasta_writer=None):
+    """ Writes a dereplicated fastq record, keeping the first word of the
+        header and adding the cluster size. The record is also written to
+        fasta_writer (a SeqWriter) if given.
+    """
+    title = header.split(' ')[0]
+    title = '{0};size={1}'.format(title, size)
+    entry = ['@' + title, seq, '+', qual]
+    out_handle.write('\n'.join(entry) + '\n')
+    if fasta_writer is not None:
+        fasta_writer.write(title, seq)
+
+def open_handle(in_file, num_cpu=1):
+    """ Opens the correct handle for the file compression. Gzipped input is
+        decompressed in the background (see gzip_reader.open_reads).
     """
-    scores = [phred_dict[x] for x in qual_string]
-    return sum(scores)/len(scores)
+    return open_reads(in_file, num_cpu)
 
 if __name__ == '__main__':
 
@@ -0,0 +1,121 @@
+# cython: boundscheck=False, wraparound=False
+#
+# Compiled versions of probabilistic_seq_match.sequences_match_prob and of
+# the member by member loop of make_cluster_consensus.recluster_members.
+# Built ahead of time with setup_cython.py (run by install.py). The python
+# modules use these if the extension has been built, else fall back to the
+# pure python versions, which give the same results.
+#
+# Base probabilities are taken from base_prob_precompute as in the python
+# version. They are copied into a 256 entry array indexed by quality
+# character on every call, so changes to the dict are always picked up.
+#
+
+from libc.string cimport memset
+from cpython.ref cimport PyObject
+from cpython.dict cimport PyDict_Next
+from cpython.bytes cimport PyBytes_Check, PyBytes_GET_SIZE, PyBytes_AS_STRING
+
+cdef double base_probs[256]
+cdef bint base_probs_set[256]
+
+cdef int set_base_probs(dict base_prob_precompute) except -1:
+    """ Copies base_prob_precompute into base_probs.
+    """
+    cdef Py_ssize_t pos = 0
+    cdef PyObject* char
+    cdef PyObject* prob
+    cdef unsigned char c
+    memset(base_probs_set, 0, sizeof(base_probs_set))
+    while PyDict_Next(base_prob_precompute, &pos, &char, &prob):
+        if PyBytes_Check(<object>char) and PyBytes_GET_SIZE(<object>char) == 1:
+            c = <unsigned char>PyBytes_AS_STRING(<object>char)[0]
+            base_probs[c] = <object>prob
+            base_probs_set[c] = True
+    return 0
+
+cdef inline double match_given_mismatch_prob(double x_prob, double y_prob):
+    return (  (1.0/3) * (1 - x_prob) * y_prob
+            + (1.0/3) * (1 - y_prob) * x_prob
+            + (2.0/9) * x_prob * y_prob )
+
+cdef inline double match_given_match_prob(double x_prob, double y_prob):
+    return (1 - x_prob) * (1 - y_prob) + (x_prob * y_prob) / 3
+
+cdef double match_prob(bytes a_seq, bytes a_qual, bytes b_seq, bytes b_qual,
+                       double stop_thresh) except? -1:
+    """ sequences_match_prob, with base_probs already set.
+    """
+    cdef Py_ssize_t i
+    cdef Py_ssize_t seq_len = len(a_seq)
+    cdef const unsigned char* a_s = a_seq
+    cdef const unsigned char* a_q = a_qual
+    cdef const unsigned char* b_s = b_seq
+    cdef const unsigned char* b_q = b_qual
+    cdef double prob = 1.0
+    cdef double prob_A, prob_B, match_prob
+
+    # Python indexing would raise on shorter b seqs or quals
+    if len(b_seq) < seq_len or len(a_qual) < seq_len or len(b_qual) < seq_len:
+        raise IndexError('string index out of range')
+
+    for i in range(seq_len):
+        if a_s[i] == b'N' or b_s[i] == b'N':
+            match_prob = 1 # Permissive with Ns
+        elif a_s[i] == b'-' or b_s[i] == b'-':
+            match_prob = 1 # Permissive with '-'s
+        else:
+            if not base_probs_set[a_q[i]]:
+                raise KeyError(chr(a_q[i]))
+            if not base_probs_set[b_q[i]]:
+                raise KeyError(chr(b_q[i]))
+            prob_A = base_probs[a_q[i]]
+            prob_B = base_probs[b_q[i]]
+            if a_s[i] == b_s[i]:
+                match_prob = match_given_match_prob(prob_A, prob_B)
+            else:
+                match_prob = match_given_mismatch_prob(prob_A, prob_B)
+        prob = prob * match_prob
+        if prob < stop_thresh:
+            return prob
+    return prob
+
+def sequences_match_prob(bytes a_seq, bytes a_qual, bytes b_seq, bytes b_qual,
+                         dict base_prob_precompute, double stop_thresh):
+    """ Given two sequences and their quality scores returns the probability
+        that they match. Same as probabilistic_seq_match.sequences_match_prob.
+    """
+    set_base_probs(base_prob_precompute)
+    return match_prob(a_seq, a_qual, b_seq, b_qual, stop_thresh)
+
+def recluster_members(list aligned_list, dict base_prob_precompute):
+    """ Same re-clustering as make_cluster_consensus.recluster_members. Each
+        member joins the first group with a member that it matches with
+        prob > 1e-20, else starts a new group.
+    """
+    # Arbitarily selected 1e-20 as threshold. Scoring stops once a prob is
+    # below it, as probs only get smaller with each base.
+    cdef double thresh = 1e-20
+    cdef list separate_clusters = []
+    cdef list group
+    cdef bint added
+    cdef bytes q_seq, q_qual
+
+    set_base_probs(base_prob_precompute)
+    for query in aligned_list:
+        q_seq = query[1]
+        q_qual = query[2]
+        added = False
+        for group in separate_clusters:
+            for target in group:
+                if match_prob(q_seq, q_qual, target[1], target[2], thresh) > thresh:
+                    group.append(query)
+                    added = True
+                    break
+            if added:
+                break
+        # If it didn't match any then add as new cluster
+        if not added:
+            separate_clusters.append([query])
+
+    return separate_clusters
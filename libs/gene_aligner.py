@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# In-process J and V gene assignment, as an alternative to running bowtie2
+# against the J_w_phix and V indexes. Each reference fasta is indexed by its
+# k-mers. Read k-mers (on both strands) vote for (reference, diagonal)
+# candidates, and the best candidates are extended into local alignments
+# along the diagonals in a small band around each seed diagonal, scored
+# like bowtie2 --local (match +2, mismatch -6, N -1, minimum score
+# 20 + 8 ln(read length)).
+#
+# The extension is ungapped, as the J/V boundaries are found from the
+# aligned ends and germline indels are rare. Reads whose best bowtie2
+# alignment has a gap may get a shorter (or no) alignment here; see
+# extras/validate_gene_aligner.py for concordance with bowtie2.
+#
+# Results are given as AlignmentRecords through AlignmentView objects, which
+# have the parts of the pysam/SamStream interface used by
+# process_target_sam.parse_sams, so they can be passed in place of SAMs.
+#
+
+import numpy as np
+from math import log
+from collections import deque
+from heapq import nsmallest
+from multiprocessing import Pool
+from bio_file_parsers import fasta_parser, fastq_block_parser
+from seq_utils import AlignmentRecord, reverse_complement
+from pool_utils import pool_map_ordered, read_chunks
+
+# Seed k-mer length and distance between the read k-mers looked up
+SEED_LEN = 10
+SEED_STEP = 2
+
+# Number of (reference, diagonal) candidates extended per strand and the
+# number of diagonals either side of each that are also tried
+MAX_CANDIDATES = 4
+BAND = 2
+
+# Local alignment scores, as bowtie2 --local defaults
+MATCH = 2
+MISMATCH = -6
+N_SCORE = -1
+MIN_SCORE_CONST = 20
+MIN_SCORE_LOG = 8
+
+# Reads sent to a pool process at a time and chunks waiting per process
+CHUNK_SIZE = 2000
+CHUNKS_PER_CPU = 2
+
+# A, C, G, T -> 0..3, anything else -> 4 (N)
+ENCODE = np.array([4] * 256, dtype=np.uint8)
+for i, base in enumerate('ACGT'):
+    ENCODE[ord(base)] = i
+    ENCODE[ord(base.lower())] = i
+
+def encode(seq):
+    """ Returns seq as a uint8 array of base codes.
+    """
+    return ENCODE[np.frombuffer(seq, dtype=np.uint8)]
+
+class GeneIndex:
+    """ K-mer seed index of the references in a fasta. Reference names are
+        the first word of each header, as in a bowtie2 index.
+    """
+
+    def __init__(self, fasta, k=SEED_LEN):
+        self.k = k
+        self.references = []
+        self.lengths = []
+        self.seqs = []
+        self.codes = []
+        # kmer: list of (ref id, ref pos)
+        self.seeds = {}
+        with open(fasta, 'r') as in_handle:
+            for header, seq in fasta_parser(in_handle):
+                ref_id = len(self.references)
+                seq = seq.upper()
+                self.references.append(header.split()[0])
+                self.lengths.append(len(seq))
+                self.seqs.append(seq)
+                self.codes.append(encode(seq))
+                for i in xrange(len(seq) - k + 1):
+                    self.seeds.setdefault(seq[i:i + k], []).append((ref_id, i))
+
+    def align(self, seq):
+        """ Returns the best local alignment of seq (either strand) as
+            (ref id, is_reverse, pos, qstart, qend, aend, score), with
+            coordinates as in a SAM/pysam record, or None if no alignment
+            reaches the minimum score.
+        """
+        min_score = MIN_SCORE_CONST + MIN_SCORE_LOG * log(max(len(seq), 1))
+        best = None
+        for is_reverse, query in [(False, seq), (True, reverse_complement(seq))]:
+            query_codes = encode(query)
+            for ref_id, diag in self._diagonals(query):
+                hit = local_diagonal(query_codes, self.codes[ref_id], diag)
+                if hit is not None and (best is None or hit[-1] > best[-1]):
+                    best = (ref_id, is_reverse) + hit
+        if best is None or best[-1] < min_score:
+            return None
+        return best
+
+    def _diagonals(self, query):
+        """ Returns the (ref id, diagonal) within BAND of the MAX_CANDIDATES
+            with the most seed hits, where diagonal is ref pos - query pos.
+        """
+        k = self.k
+        seeds = self.seeds
+        votes = {}
+        for i in xrange(0, len(query) - k + 1, SEED_STEP):
+            for ref_id, ref_pos in seeds.get(query[i:i + k], ()):
+                key = (ref_id, ref_pos - i)
+                votes[key] = votes.get(key, 0) + 1
+        candidates = nsmallest(MAX_CANDIDATES, votes.iteritems(), key=lambda x: (-x[1], x[0]))
+
+        # Candidates close together share diagonals, so try each only once
+        diagonals = []
+        for (ref_id, diag), _ in candidates:
+            for d in xrange(diag - BAND, diag + BAND + 1):
+                if (ref_id, d) not in diagonals:
+                    diagonals.append((ref_id, d))
+        return diagonals
+
+def local_diagonal(query_codes, ref_codes, diag):
+    """ Best scoring ungapped local alignment of query and ref along a
+        diagonal (ref pos - query pos), found with a cumulative sum (Kadane).
+        Returns (pos, qstart, qend, aend, score) or None.
+    """
+    q_from = max(0, -diag)
+    q_to = min(len(query_codes), len(ref_codes) - diag)
+    if q_to <= q_from:
+        return None
+    q = query_codes[q_from:q_to]
+    r = ref_codes[q_from + diag:q_to + diag]
+
+    # Score each aligned base
+    scores = np.where(q == r, MATCH, MISMATCH)
+    scores[(q == 4) | (r == 4)] = N_SCORE
+
+    # Best segment ends where the running sum is furthest above its minimum
+    cum = np.concatenate(([0], np.cumsum(scores)))
+    running_min = np.minimum.accumulate(cum)
+    end = int(np.argmax(cum - running_min))
+    score = int(cum[end] - running_min[end])
+    if score <= 0:
+        return None
+    # Start at the last minimum before the end (no zero scoring prefix)
+    start = end - int(np.argmin(cum[end::-1]))
+
+    qstart = q_from + start
+    qend = q_from + end
+    return qstart + diag, qstart, qend, qend + diag, score
+
+class GeneAligner:
+    """ Aligns reads against the J (with contaminants) and V references.
+    """
+
+    def __init__(self, j_fasta, v_fasta):
+        self.j_fasta = j_fasta
+        self.v_fasta = v_fasta
+        self.j_index = GeneIndex(j_fasta)
+        self.v_index = GeneIndex(v_fasta)
+
+    def align_pair(self, seq):
+        """ Returns the (J hit, V hit) of a read, see GeneIndex.align.
+        """
+        return self.j_index.align(seq), self.v_index.align(seq)
+
+    def align_reads(self, in_fastq, num_cpu=1, chunk_size=CHUNK_SIZE):
+        """ Aligns every read in in_fastq. Returns J and V AlignmentViews which
+            give the alignments in read order, like the --reorder'ed J and V
+            SAMs from bowtie2. If num_cpu > 1 chunks of reads are aligned by
+            a pool of processes.
+        """
+        pairs = self._aligned_pairs(in_fastq, num_cpu, chunk_size)
+        j_view = AlignmentView(self.j_index.references, self.j_index.lengths)
+        v_view = AlignmentView(self.v_index.references, self.v_index.lengths)
+        j_view.pair_with(v_view, pairs)
+        return j_view, v_view
+
+    def _aligned_pairs(self, in_fastq, num_cpu, chunk_size):
+        """ Yields a (J, V) AlignmentRecord pair for each read in in_fastq.
+        """
+        with open(in_fastq, 'r') as in_handle:
+            chunks = read_chunks(fastq_block_parser(in_handle), chunk_size)
+            if num_cpu > 1:
+                pool = Pool(num_cpu, initializer=init_align_worker,
+                            initargs=(self.j_fasta, self.v_fasta))
+                try:
+                    for chunk, hits in pool_map_ordered(pool, align_chunk, chunks,
+                                                        num_cpu * CHUNKS_PER_CPU):
+                        for (title, seq, qual), (j_hit, v_hit) in zip(chunk, hits):
+                            yield hit_record(title, seq, qual, j_hit), hit_record(title, seq, qual, v_hit)
+                finally:
+                    pool.terminate()
+            else:
+                for chunk in chunks:
+                    for title, seq, qual in chunk:
+                        j_hit, v_hit = self.align_pair(seq)
+                        yield hit_record(title, seq, qual, j_hit), hit_record(title, seq, qual, v_hit)
+
+class AlignmentView:
+    """ One side (J or V) of the aligned pairs, with the references, lengths,
+        nreferences, getrname, fetch and close of a pysam Samfile/SamStream.
+    """
+
+    def __init__(self, references, lengths):
+        self.references = tuple(references)
+        self.lengths = tuple(lengths)
+        self.nreferences = len(references)
+        self._queue = deque()
+        self._pairs = None
+        self._side = None
+        self._other = None
+
+    def pair_with(self, other, pairs):
+        """ Shares the (J, V) pairs iterator with other, this view giving the
+            first of each pair and other the second.
+        """
+        self._pairs, self._side, self._other = pairs, 0, other
+        other._pairs, other._side, other._other = pairs, 1, self
+
+    def getrname(self, tid):
+        return self.references[tid]
+
+    def fetch(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        # Take a record already read for this side, else read the next pair
+        if self._queue:
+            return self._queue.popleft()
+        pair = next(self._pairs)
+        self._other._queue.append(pair[1 - self._side])
+        return pair[self._side]
+
+    def close(self):
+        pass
+
+def hit_record(title, seq, qual, hit):
+    """ Returns an AlignmentRecord for a read and its hit from
+        GeneIndex.align, with the seq and qual oriented as in a SAM.
+    """
+    if hit is None:
+        return AlignmentRecord(title, True, False, -1, -1, 0, len(seq), None, seq, qual)
+    ref_id, is_reverse, pos, qstart, qend, aend, _ = hit
+    if is_reverse:
+        seq, qual = reverse_complement(seq), qual[::-1]
+    return AlignmentRecord(title, False, is_reverse, ref_id, pos, qstart, qend, aend, seq, qual)
+
+def init_align_worker(j_fasta, v_fasta):
+    """ Builds the GeneAligner used by align_chunk in a pool process.
+    """
+    global worker_aligner
+    worker_aligner = GeneAligner(j_fasta, v_fasta)
+
+def align_chunk(chunk):
+    """ Returns the chunk of (title, seq, qual) reads with their (J hit,
+        V hit).
+    """
+    return chunk, [worker_aligner.align_pair(seq) for _, seq, _ in chunk]
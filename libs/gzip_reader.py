@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Input layer for raw read files. Gzipped files are decompressed in a
+# background thread and handed to the parser as large blocks through a bounded
+# queue, so decompression no longer runs in the same thread as parsing.
+#
+# BGZF files (gzip members that carry their compressed size in a 'BC' extra
+# field, as written by bgzip) are split into members which are inflated in
+# parallel by a pool of processes. Other multi-member gzips are decoded member
+# by member in the background thread, as their member boundaries can't be
+# found without inflating them.
+#
+
+import zlib
+import struct
+import threading
+from Queue import Queue, Full
+from collections import deque
+from multiprocessing import Pool
+
+# Compressed bytes read at a time, decompressed bytes per queued block and the
+# number of blocks that can be waiting in the queue
+READ_SIZE = 1024 ** 2
+BLOCK_SIZE = 4 * 1024 ** 2
+QUEUE_BLOCKS = 8
+
+# BGZF members that can be waiting on the pool per process
+MEMBERS_PER_CPU = 64
+
+def open_reads(file_name, num_cpu=1):
+    """ Returns a handle to read file_name. If it ends in .gz it is
+        decompressed in the background, using up to num_cpu processes for BGZF
+        files.
+    """
+    if file_name.split('.')[-1] == 'gz':
+        return ThreadedGzipReader(file_name, num_cpu)
+    else:
+        return open(file_name, 'r')
+
+def is_bgzf(file_name):
+    """ Returns True if the first member of the gzip has a BGZF 'BC' extra
+        field holding its compressed size.
+    """
+    with open(file_name, 'rb') as in_handle:
+        header = in_handle.read(18)
+    return (len(header) == 18 and header[:4] == '\x1f\x8b\x08\x04'
+            and header[12:14] == 'BC' and header[14:16] == '\x02\x00')
+
+def bgzf_members(handle):
+    """ Yields the raw bytes of each BGZF member in handle.
+    """
+    while True:
+        header = handle.read(18)
+        if not header:
+            return
+        if len(header) < 18 or header[12:14] != 'BC':
+            raise IOError('Invalid BGZF member header')
+        # BSIZE is the total member size minus 1
+        bsize = struct.unpack('<H', header[16:18])[0]
+        member = header + handle.read(bsize + 1 - 18)
+        if len(member) < bsize + 1:
+            raise IOError('Compressed file ended before the end of a BGZF member')
+        yield member
+
+def member_ended(decomp):
+    """ Returns True if decomp (a gzip zlib.decompressobj) has read the whole
+        member, including the trailer whose CRC and size zlib checks. Python 2
+        decompressobjs have no eof attribute, but once the member has ended
+        any further input is left in unused_data, so a byte is fed to see if
+        it is. Only used at the end of the input.
+    """
+    try:
+        decomp.decompress('\x00')
+    except zlib.error:
+        return False
+    return decomp.unused_data != ''
+
+def inflate_member(member):
+    """ Decompresses a single gzip member.
+    """
+    return zlib.decompress(member, 16 + zlib.MAX_WBITS)
+
+class ThreadedGzipReader:
+    """ Read only file-like object for a gzip file that is decompressed in a
+        background thread. Supports read, readline, iteration over lines and
+        use as a context manager.
+    """
+
+    def __init__(self, file_name, num_cpu=1):
+        self.name = file_name
+        self.num_cpu = num_cpu
+        self._handle = open(file_name, 'rb')
+        self._queue = Queue(QUEUE_BLOCKS)
+        self._closed = False
+        self._eof = False
+        self._buf = ''
+        self._pos = 0
+
+        if num_cpu > 1 and is_bgzf(file_name):
+            target = self._fill_bgzf
+        else:
+            target = self._fill_stream
+        self._thread = threading.Thread(target=target)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        """ Puts item on the queue, giving up if the reader is closed.
+        """
+        while not self._closed:
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _fill_stream(self):
+        """ Inflates the file in this thread, starting a new decompressor
+            at the start of each gzip member.
+        """
+        try:
+            decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            member_start = True
+            blocks = []
+            blocks_len = 0
+            while True:
+                data = self._handle.read(READ_SIZE)
+                if not data:
+                    break
+                while data:
+                    # Ignore zero padding after the last member
+                    if member_start:
+                        data = data.lstrip('\x00')
+                        if not data:
+                            break
+                        member_start = False
+                    block = decomp.decompress(data)
+                    blocks.append(block)
+                    blocks_len += len(block)
+                    data = decomp.unused_data
+                    if data:
+                        decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                        member_start = True
+                if blocks_len >= BLOCK_SIZE:
+                    if not self._put(''.join(blocks)):
+                        return
+                    blocks = []
+                    blocks_len = 0
+            # A member still being inflated at the end of the file is truncated
+            if not member_start and not member_ended(decomp):
+                raise IOError('Compressed file ended before the end of the last gzip member')
+            blocks.append(decomp.flush())
+            self._put(''.join(blocks))
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+
+    def _fill_bgzf(self):
+        """ Splits the file into BGZF members and inflates them in a process
+            pool, keeping a bounded number of members in flight and putting
+            the results on the queue in order.
+        """
+        pool = Pool(self.num_cpu)
+        pending = deque()
+        try:
+            blocks = []
+            blocks_len = 0
+            members = bgzf_members(self._handle)
+            while True:
+                # Top up the members being inflated
+                while len(pending) < self.num_cpu * MEMBERS_PER_CPU:
+                    member = next(members, None)
+                    if member is None:
+                        break
+                    pending.append(pool.apply_async(inflate_member, (member,)))
+                if not pending:
+                    break
+                # Collect the oldest
+                block = pending.popleft().get()
+                blocks.append(block)
+                blocks_len += len(block)
+                if blocks_len >= BLOCK_SIZE:
+                    if not self._put(''.join(blocks)):
+                        return
+                    blocks = []
+                    blocks_len = 0
+            self._put(''.join(blocks))
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+        finally:
+            # Terminating with results still in flight can deadlock the pool
+            for result in pending:
+                result.wait()
+            pool.terminate()
+
+    def _next_block(self):
+        """ Appends the next decompressed block to the buffer. Returns False
+            at the end of the file.
+        """
+        if self._eof:
+            return False
+        block = self._queue.get()
+        if isinstance(block, Exception):
+            # Let the thread clean up (e.g. its pool) before raising
+            self._thread.join()
+            raise block
+        if block is None:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + block
+        self._pos = 0
+        return True
+
+    def read(self, size=-1):
+        if size < 0:
+            parts = [self._buf[self._pos:]]
+            self._buf = ''
+            self._pos = 0
+            while self._next_block():
+                parts.append(self._buf)
+                self._buf = ''
+            return ''.join(parts)
+        while len(self._buf) - self._pos < size and self._next_block():
+            pass
+        data = self._buf[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+    def readline(self):
+        while True:
+            end = self._buf.find('\n', self._pos)
+            if end != -1:
+                line = self._buf[self._pos:end + 1]
+                self._pos = end + 1
+                return line
+            if not self._next_block():
+                line = self._buf[self._pos:]
+                self._pos += len(line)
+                return line
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        self._closed = True
+        self._thread.join()
+        self._handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
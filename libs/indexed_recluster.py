@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Indexed re-clustering of aligned cd-hit cluster members, an alternative
+# to the exact make_cluster_consensus.recluster_members. The exact mode
+# compares each member against every member of every group found so far,
+# which is quadratic in the cluster size. Here each group keeps at most
+# max_reps representatives (its first members), and a member is only
+# compared against those.
+#
+# Before the full match probability is worked out by the python
+# sequences_match_prob, representatives are ruled out with an upper bound
+# on it. Matching, N and '-' bases all have a match prob of at most 1, so
+# the product over the mismatched bases alone (looked up from
+# probabilistic_seq_match.LOG_MISMATCH) bounds the match prob of the pair.
+# Representatives where that is already below the threshold can't match,
+# so the prefilter never changes the result. Only the bounded set of
+# representatives can: a member that only matches a non representative
+# member of a group starts a new group. See
+# extras/compare_recluster_modes.py for how often the modes disagree.
+#
+
+from math import log
+from itertools import islice
+from probabilistic_seq_match import sequences_match_prob
+import probabilistic_seq_match
+
+# Number of members of each group that later members are compared with
+MAX_REPS = 32
+
+# Arbitarily selected 1e-20 as threshold, as in recluster_members
+THRESH = 1e-20
+
+# Number of representatives in the first chunk scored for each member
+FIRST_CHUNK = 4
+
+# Slack on the log bound so that rounding never rules out a true match
+BOUND_SLACK = 1e-9
+
+def recluster_members_indexed(aligned_list, base_prob_precompute, max_reps=MAX_REPS):
+    """ Re-clusters aligned (header, seq, qual) members. Each member joins the
+        first group with a representative it matches (prob > THRESH), else
+        starts a new group. Returns the list of groups.
+    """
+    # The compiled sequences_match_prob (see setup_cython.py) stops as soon
+    # as a pair is below THRESH, which is cheaper than the prefilter, so the
+    # prefilter is only used with the python version (and needs numpy)
+    np = probabilistic_seq_match.np
+    seq_lens = set([len(x[1]) for x in aligned_list] + [len(x[2]) for x in aligned_list])
+    bound = None
+    if (np is not None and len(seq_lens) == 1 and 0 not in seq_lens and
+            sequences_match_prob is probabilistic_seq_match.python_sequences_match_prob):
+        bound = MismatchBound(aligned_list)
+
+    separate_clusters = []
+    # Indexes into aligned_list of the representatives of each group
+    reps = []
+    for q_index, query in enumerate(aligned_list):
+        q_header, q_seq, q_qual = query
+        group_index = None
+
+        # Representatives in group order, taken as needed. They are
+        # prefiltered and scored in chunks of doubling size, so members that
+        # match one of the first groups don't need the bound worked out for
+        # every representative.
+        candidates = ((g, t) for g, group_reps in enumerate(reps) for t in group_reps)
+        chunk_size = FIRST_CHUNK
+        chunk = list(islice(candidates, chunk_size))
+        while chunk and group_index is None:
+            if bound is not None:
+                chunk = bound.survivors(q_index, chunk)
+            for g, t_index in chunk:
+                _, t_seq, t_qual = aligned_list[t_index]
+                prob = sequences_match_prob(q_seq, q_qual, t_seq, t_qual, base_prob_precompute, THRESH)
+                if prob > THRESH:
+                    group_index = g
+                    break
+            chunk_size *= 2
+            chunk = list(islice(candidates, chunk_size))
+
+        if group_index is None:
+            separate_clusters.append([query])
+            reps.append([q_index])
+        else:
+            separate_clusters[group_index].append(query)
+            if len(reps[group_index]) < max_reps:
+                reps[group_index].append(q_index)
+
+    return separate_clusters
+
+class MismatchBound:
+    """ Upper bound on the log match prob of pairs of aligned members, from
+        the product of the match probs of their mismatched bases only.
+    """
+
+    def __init__(self, aligned_list, offset=33):
+        np = probabilistic_seq_match.np
+        self.np = np
+        num_seqs = len(aligned_list)
+        seq_len = len(aligned_list[0][1])
+        self.seqs = np.frombuffer(''.join([x[1] for x in aligned_list]),
+                                  dtype=np.uint8).reshape(num_seqs, seq_len)
+        scores = np.frombuffer(''.join([x[2] for x in aligned_list]), dtype=np.uint8)
+        self.scores = scores.astype(np.intp).reshape(num_seqs, seq_len) - offset
+        # Bases that never count as a mismatch
+        self.skip = (self.seqs == ord('N')) | (self.seqs == ord('-'))
+        self.log_thresh = log(THRESH) - BOUND_SLACK
+
+    def survivors(self, q_index, candidates):
+        """ Returns the (group, member index) candidates whose bound with the
+            member q_index is above the threshold, in the same order.
+        """
+        np = self.np
+        t_indexes = np.array([x[1] for x in candidates], dtype=np.intp)
+        t_seqs = self.seqs[t_indexes]
+        mismatch = (t_seqs != self.seqs[q_index]) & ~self.skip[t_indexes] & ~self.skip[q_index]
+        log_probs = probabilistic_seq_match.LOG_MISMATCH[self.scores[q_index], self.scores[t_indexes]]
+        bounds = np.where(mismatch, log_probs, 0).sum(axis=1)
+        keep = bounds > self.log_thresh
+        return [x for x, k in zip(candidates, keep) if k]
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Screens reads for contaminants (the phiX174 spike-in and the pUPATrap
+# vector) before alignment, so that they don't have to go through the full
+# J and V bowtie2 alignments just to be discarded. A hashed set of the
+# k-mers in each contaminant reference (both strands) is built in memory,
+# and reads where most of the sampled k-mers hit one contaminant are
+# written straight to that contaminant's output file.
+#
+
+from bio_file_parsers import fasta_parser, fastq_block_parser, SeqWriter
+from seq_utils import reverse_complement
+
+# K-mer length, distance between the read k-mers that are looked up and the
+# fraction of them that must hit a contaminant for the read to be diverted
+KMER_LEN = 21
+KMER_STEP = 4
+MIN_HIT_FRAC = 0.5
+
+class KmerScreen:
+    """ K-mer set built from (category, fasta file) references. classify
+        returns the category of an obvious contaminant read, else None.
+    """
+
+    def __init__(self, references, k=KMER_LEN, step=KMER_STEP, min_hit_frac=MIN_HIT_FRAC):
+        self.k = k
+        self.step = step
+        self.min_hit_frac = min_hit_frac
+        self.categories = []
+
+        # kmer: index of its category in self.categories
+        self.kmers = {}
+        for category, fasta in references:
+            cat_index = len(self.categories)
+            self.categories.append(category)
+            with open(fasta, 'r') as in_handle:
+                for _, seq in fasta_parser(in_handle):
+                    seq = seq.upper()
+                    for strand in [seq, reverse_complement(seq)]:
+                        for i in xrange(len(strand) - k + 1):
+                            self.kmers[strand[i:i + k]] = cat_index
+
+    def classify(self, seq):
+        """ Returns the category of seq if at least min_hit_frac of its
+            sampled k-mers hit that category, else None.
+        """
+        k = self.k
+        positions = xrange(0, len(seq) - k + 1, self.step)
+        if not positions:
+            return None
+        seq = seq.upper()
+        kmers = self.kmers
+
+        # Count the hits to each category
+        hits = [0] * len(self.categories)
+        for i in positions:
+            cat_index = kmers.get(seq[i:i + k])
+            if cat_index is not None:
+                hits[cat_index] += 1
+
+        best = max(hits)
+        if best > 0 and best >= self.min_hit_frac * len(positions):
+            return self.categories[hits.index(best)]
+        return None
+
+def screen_fastq(in_fastq, out_fastq, screen, router):
+    """ Writes the reads in in_fastq that the screen doesn't classify as
+        contaminants to out_fastq. Contaminant reads are written to router
+        under their category. Returns a dict of category to number of reads
+        diverted, counting the ;size= of each read.
+    """
+    diverted = dict([(category, 0) for category in screen.categories])
+    with open(in_fastq, 'r') as in_handle:
+        with open(out_fastq, 'w') as out_handle:
+            with SeqWriter(out_handle, 'fastq') as writer:
+                for title, seq, qual in fastq_block_parser(in_handle):
+                    category = screen.classify(seq)
+                    if category is None:
+                        writer.write(title, seq, qual)
+                        continue
+                    size = int(title.split('size=')[-1])
+                    router.write(category, title, seq, size)
+                    diverted[category] += size
+    return diverted
@@ -2,23 +2,56 @@
 
 import re
 import sys
-from bio_file_parsers import fastq_parser, clstr_parser, phred_score_dict
+from bio_file_parsers import fastq_parser, clstr_parser, phred_score_dict, SeqWriter
 from random import choice
-from probabilistic_seq_match import sequences_match_prob
+from probabilistic_seq_match import sequences_match_prob, sequences_match_log_probs
+import probabilistic_seq_match
+from math import log
+from itertools import islice
+try:
+    import fast_seq_match
+except ImportError:
+    fast_seq_match = None
+from seq_keys import PackedFastqDict
+from seq_index import IndexedReads
+from quality_stats import phred_scores, quality_summaries
+from numpy_consensus import column_consensus
+import sliding_align
+from indexed_recluster import recluster_members_indexed
 from operator import itemgetter
 
 def main(args):
     make_consensus(args['in_fastq'], args['in_clstr'], args['out_file'])
 
 
-def make_consensus(ndn_fastq, clstr_meta, out_fastq):
-    """ Main function for creating consensus sequences.
+def make_consensus(ndn_fastq, clstr_meta, out_fastq, packed_seqs=False, indexed=False,
+                   out_fasta=None, aligner='numpy',
+                   recluster='exact', out_qual_stats=None):
+    """ Main function for creating consensus sequences. If packed_seqs is
+        True the member seqs are held in memory 2-bit packed. If indexed is
+        True members are instead fetched by header from an mmapped index of
+        ndn_fastq (see seq_index.IndexedReads). If out_fasta is given the
+        consensus seqs are also written there as fasta for the next round of
+        cd-hit. aligner picks how members are aligned to their centroid,
+        'numpy' (see sliding_align, used if numpy is installed) or 'python'.
+        recluster is 'exact' to compare members against every member of each
+        group, or 'indexed' to only compare against group representatives
+        (see indexed_recluster). If out_qual_stats is given the mean and min
+        Phred score and expected errors of each consensus are written there,
+        see write_qual_stats.
     """
     # Load fasta into a dictionary
-    fastq_dict = make_fastq_dict(ndn_fastq)
+    if indexed:
+        fastq_dict = IndexedReads(ndn_fastq)
+    else:
+        fastq_dict = make_fastq_dict(ndn_fastq, packed_seqs)
     num_of_clusters = 0
     total_clus_size = 0
 
+    # Functions to align members to their centroid and re-cluster them
+    align_func = choose_aligner(aligner)
+    recluster_func = choose_recluster(recluster)
+
     # Pattern to pick out header
     pattern = re.compile(r">(.*)\.\.\..*((([0-9]+):([0-9]+):([0-9]+):([0-9]+))|\*)")
 
@@ -37,7 +70,8 @@ def make_consensus(ndn_fastq, clstr_meta, out_fastq):
         for _, lines in clstr_parser(in_handle):
 
                 # Check members of each cluster are a good match
-                separate_clusters = check_cluster_membership(lines, fastq_dict, pattern, base_prob_precompute)
+                separate_clusters = check_cluster_membership(lines, fastq_dict, pattern, base_prob_precompute,
+                                                             align_func, recluster_func)
 
                 # For each separate cluster, create a new consensus seq and qual string
                 for cluster_list in separate_clusters:
@@ -49,12 +83,43 @@ def make_consensus(ndn_fastq, clstr_meta, out_fastq):
                     out_clusters.append((header, cons_seq, cons_qual, clus_size))
 
     # Write fastq entries in size order
+    out_clusters.sort(reverse=True, key=itemgetter(3))
+    write_consensus(out_clusters, out_fastq, out_fasta)
+    if out_qual_stats is not None:
+        write_qual_stats(out_clusters, out_qual_stats)
+
+    return num_of_clusters, total_clus_size
+
+def write_consensus(clusters, out_fastq, out_fasta=None):
+    """ Writes the consensus records to out_fastq and, if given, to
+        out_fasta in the same pass.
+    """
     with open(out_fastq, 'w') as out_handle:
-        for header, cons_seq, cons_qual, clus_size in sorted(out_clusters, reverse=True, key=itemgetter(3)):
+        fasta_handle = None
+        if out_fasta is not None:
+            fasta_handle = open(out_fasta, 'w')
+            fasta_writer = SeqWriter(fasta_handle)
+        for header, cons_seq, cons_qual, clus_size in clusters:
             out = ['@' + header, cons_seq, '+', cons_qual]
             out_handle.write('\n'.join(out) + '\n')
-
-    return num_of_clusters, total_clus_size
+            if fasta_handle is not None:
+                fasta_writer.write(header, cons_seq)
+        if fasta_handle is not None:
+            fasta_writer.close()
+
+def write_qual_stats(clusters, out_file):
+    """ Writes the header, size, length, mean and min Phred score and
+        expected number of errors of each consensus record to out_file as a
+        tab separated table. The scores of all records are worked out in one
+        batch by quality_stats.quality_summaries.
+    """
+    means, mins, exp_errs = quality_summaries([x[2] for x in clusters])
+    with open(out_file, 'w') as out_handle:
+        out_handle.write('\t'.join(['header', 'size', 'length', 'mean_qual', 'min_qual',
+                                    'expected_errors']) + '\n')
+        for (header, cons_seq, _, clus_size), mean, min_qual, exp_err in zip(clusters, means, mins, exp_errs):
+            out_handle.write('{0}\t{1}\t{2}\t{3:.2f}\t{4:.0f}\t{5:.4f}\n'.format(
+                header, clus_size, len(cons_seq), mean, min_qual, exp_err))
 
 def clusters_consensus(cluster_list, phred_dict, phred_dict_inv):
     """ Creates a consensus sequence by taking the highest quality base
@@ -64,39 +129,42 @@ def clusters_consensus(cluster_list, phred_dict, phred_dict_inv):
     headers, seqs, quals = zip(*cluster_list)
     seq_len = len(seqs[0])
 
-    # Convert qual string to phred scores
-    quals = list(quals)
-    for i in range(len(quals)):
-        quals[i] = [phred_dict[x] for x in quals[i]]
-
-    # Create consensus seq and qual
-    cons_seq = [None] * seq_len
-    cons_qual = [None] * seq_len
-    for i in range(seq_len):
-        # Check that more that 50% of reads have a base here and that at least
-        # 1 base has quailty >= 20
-        if not check_50perc_bases(seqs, quals, i, 20):
-            cons_seq[i] = '-'
-            cons_qual[i] = '-'
-        else:
-            # Find the highest quality base
-            d = {'A':0, 'G':0, 'C':0, 'T':0, 'N':0}
-            for j in range(len(seqs)):
-                base = seqs[j][i]
-                qual = int(quals[j][i])
-                try:
-                    d[base] = max(d[base], qual)
-                except KeyError:
-                    # Catches '-'
-                    pass
-            best_base, best_qual = sorted(d.iteritems(), key=itemgetter(1), reverse=True)[0]
-            # Build consensus seq
-            cons_seq[i] = best_base
-            cons_qual[i] = best_qual
-
-    # Convert to strings
-    cons_seq = ''.join(cons_seq)
-    cons_qual = ''.join([phred_dict_inv[x] if not x == '-' else '-' for x  in cons_qual  ])
+    # Vectorised consensus, if the members can be stacked into arrays
+    columns = column_consensus(seqs, quals, phred_dict_inv)
+    if columns is not None:
+        cons_seq, cons_qual = columns
+    else:
+        # Convert qual string to phred scores
+        quals = phred_scores(quals)
+
+        # Create consensus seq and qual
+        cons_seq = [None] * seq_len
+        cons_qual = [None] * seq_len
+        for i in range(seq_len):
+            # Check that more that 50% of reads have a base here and that at least
+            # 1 base has quailty >= 20
+            if not check_50perc_bases(seqs, quals, i, 20):
+                cons_seq[i] = '-'
+                cons_qual[i] = '-'
+            else:
+                # Find the highest quality base
+                d = {'A':0, 'G':0, 'C':0, 'T':0, 'N':0}
+                for j in range(len(seqs)):
+                    base = seqs[j][i]
+                    qual = int(quals[j][i])
+                    try:
+                        d[base] = max(d[base], qual)
+                    except KeyError:
+                        # Catches '-'
+                        pass
+                best_base, best_qual = sorted(d.iteritems(), key=itemgetter(1), reverse=True)[0]
+                # Build consensus seq
+                cons_seq[i] = best_base
+                cons_qual[i] = best_qual
+
+        # Convert to strings
+        cons_seq = ''.join(cons_seq)
+        cons_qual = ''.join([phred_dict_inv[x] if not x == '-' else '-' for x  in cons_qual  ])
 
     # Calc new cluster size
     clus_size = sum_cluster_sizes(headers)
@@ -173,10 +241,18 @@ def check_50perc_bases(seq_list, qual_list, i, qual_thres):
     else:
         return False
 
-def check_cluster_membership(members, fastq_dict, pattern, base_prob_precompute):
+def check_cluster_membership(members, fastq_dict, pattern, base_prob_precompute,
+                             align_func=None, recluster_func=None):
     """ Checks each cd-hit cluster to see if members are a good match.
-        Returns list of separate clusters if not.
+        Returns list of separate clusters if not. align_func aligns each
+        member to the centroid, align_seq by default. recluster_func splits
+        the aligned members into groups, recluster_members by default.
     """
+    if align_func is None:
+        align_func = align_seq
+    if recluster_func is None:
+        recluster_func = recluster_members
+
     # Return if there is only 1 member
     if len(members) == 1:
         header = pattern.search(members[0]).group(1)
@@ -200,7 +276,7 @@ def check_cluster_membership(members, fastq_dict, pattern, base_prob_precompute)
     max_front, max_back = 0, 0 # Max number of insertions at front and back
     for other in others:
         other_seq = fastq_dict[other][0]
-        front, back = align_seq(centroid_seq, other_seq)
+        front, back = align_func(centroid_seq, other_seq)
         alignments[other] = (front, back)
         # Update max insertions
         if front > max_front:
@@ -221,12 +297,20 @@ def check_cluster_membership(members, fastq_dict, pattern, base_prob_precompute)
         aligned.append((other, seq, qual))
 
     # Re-cluster members using their qual strings for information
-    separate_clusters = recluster_members(aligned, base_prob_precompute)
+    separate_clusters = recluster_func(aligned, base_prob_precompute)
 
     return separate_clusters
 
 def recluster_members(aligned_list, base_prob_precompute):
 
+    # Compiled loop, if it has been built (see setup_cython.py)
+    if fast_seq_match is not None:
+        return fast_seq_match.recluster_members(aligned_list, base_prob_precompute)
+
+    # Score each query against all members at once if numpy is available
+    if probabilistic_seq_match.np is not None and len(set([len(x[1]) for x in aligned_list])) == 1:
+        return recluster_members_batch(aligned_list)
+
     # New clusters
     separate_clusters = []
 
@@ -264,6 +348,45 @@ def recluster_members(aligned_list, base_prob_precompute):
     return separate_clusters
 
 
+def recluster_members_batch(aligned_list):
+    """ Same re-clustering as recluster_members, but each query is scored
+        against the members of the groups so far with sequences_match_log_probs,
+        in chunks of doubling size. The query joins the first group with a
+        member it matches.
+    """
+    # Arbitarily selected 1e-20 as threshold
+    thresh = 1e-20
+    log_thresh = log(thresh)
+
+    separate_clusters = []
+    for query in aligned_list:
+        q_header, q_seq, q_qual = query
+        # Members in the order recluster_members compares them, taken as
+        # needed so a query matching one of the first groups is cheap
+        targets = ((group, target) for group in separate_clusters for target in group)
+        matched_group = None
+        # Small chunks first, as most queries match one of the first groups
+        chunk_size = 4
+        chunk = list(islice(targets, chunk_size))
+        while chunk:
+            log_probs = sequences_match_log_probs(q_seq, q_qual,
+                                                  [x[1][1] for x in chunk],
+                                                  [x[1][2] for x in chunk],
+                                                  thresh)
+            matches = log_probs > log_thresh
+            if matches.any():
+                matched_group = chunk[int(matches.argmax())][0]
+                break
+            chunk_size *= 2
+            chunk = list(islice(targets, chunk_size))
+        if matched_group is not None:
+            matched_group.append(query)
+        else:
+            # If it didn't match any then add as new cluster
+            separate_clusters.append([query])
+
+    return separate_clusters
+
 def pad_alignment(seq, max_front, max_back, front, back):
 
     pad = '-'
@@ -271,6 +394,26 @@ def pad_alignment(seq, max_front, max_back, front, back):
     add_back = max_back - back
     return add_front * pad + seq + add_back * pad
 
+def choose_recluster(recluster):
+    """ Returns the re-clustering function for recluster, 'exact' or
+        'indexed'.
+    """
+    if recluster == 'exact':
+        return recluster_members
+    elif recluster == 'indexed':
+        return recluster_members_indexed
+    raise ValueError('Unknown recluster mode: {0}'.format(recluster))
+
+def choose_aligner(aligner):
+    """ Returns the align_seq function for aligner, 'numpy' or 'python'.
+        Falls back to python if numpy isn't installed.
+    """
+    if aligner == 'numpy' and sliding_align.np is not None:
+        return sliding_align.align_seq
+    elif aligner in ['numpy', 'python']:
+        return align_seq
+    raise ValueError('Unknown aligner: {0}'.format(aligner))
+
 def align_seq(centroid, other):
     """ Returns the (front, back) front/back are the numer of insertions or del
         of the other compared to the centroid
@@ -304,10 +447,14 @@ def count_matches(seqA, seqB):
             score += 1
     return score
 
-def make_fastq_dict(fasta):
-    """ Parses the fasta file into a dictionary
+def make_fastq_dict(fasta, packed=False):
+    """ Parses the fasta file into a dictionary. If packed is True then seqs
+        are held as 2-bit packed keys (see seq_keys.PackedFastqDict).
     """
-    fastq_dict = {}
+    if packed:
+        fastq_dict = PackedFastqDict()
+    else:
+        fastq_dict = {}
     with open(fasta, 'r') as in_handle:
         for header, seq, qual in fastq_parser(in_handle):
             fastq_dict[header] = (seq, qual)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Vectorised consensus of aligned (padded) cluster members, used by
+# clusters_consensus in make_cluster_consensus(_futures). The members are
+# stacked into 2-D uint8 arrays of seqs and quals. Coverage, the highest
+# quality of each base and the winning base are then found for every
+# column at once, rather than by rescanning the members for each position.
+#
+# Gives the same consensus as the per position loop: a column is '-' unless
+# at least half the members have a base there, the winner is the base with
+# the highest quality (ties going to the first base in BASE_ORDER) and
+# characters other than A, C, G, T and N are ignored. Returns None when the
+# loop has to be used instead (no numpy, e.g. under pypy, or members of
+# unequal length).
+#
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Order bases are considered in for ties. The loop takes the first maximum
+# in the iteration order of its {'A', 'G', 'C', 'T', 'N'} dict, which
+# depends on the interpreter, so the order is taken from an identical dict.
+BASE_ORDER = ''.join({'A':0, 'G':0, 'C':0, 'T':0, 'N':0})
+
+def column_consensus(seqs, quals, phred_dict_inv, offset=33):
+    """ Returns the consensus seq and qual strings of the padded seqs and
+        quals, with '-' in both where under half of seqs have a base.
+        Returns None if the members can't be stacked.
+    """
+    if np is None:
+        return None
+    lengths = set([len(x) for x in seqs] + [len(x) for x in quals])
+    if len(lengths) != 1 or 0 in lengths:
+        return None
+    num_seqs = len(seqs)
+    seq_len = lengths.pop()
+
+    seq_arr = np.frombuffer(''.join(seqs), dtype=np.uint8).reshape(num_seqs, seq_len)
+    qual_arr = np.frombuffer(''.join(quals), dtype=np.uint8).reshape(num_seqs, seq_len)
+    qual_arr = qual_arr.astype(np.int16) - offset
+
+    # Columns where at least 50% of members have a base
+    present = (seq_arr != ord('-')).sum(axis=0)
+    covered = 2 * present >= num_seqs
+
+    # Highest quality of each base in each column, 0 if it isn't there
+    best_quals = np.zeros((len(BASE_ORDER), seq_len), dtype=np.int16)
+    for i, base in enumerate(BASE_ORDER):
+        base_quals = np.where(seq_arr == ord(base), qual_arr, 0)
+        best_quals[i] = base_quals.max(axis=0)
+
+    # argmax gives the first of tied bases
+    winners = best_quals.argmax(axis=0)
+    winner_quals = best_quals[winners, np.arange(seq_len)]
+
+    # Build seq and qual strings, with '-' for uncovered columns
+    base_codes = np.frombuffer(BASE_ORDER, dtype=np.uint8)
+    qual_codes = np.zeros(max(phred_dict_inv) + 1, dtype=np.uint8)
+    for score, char in phred_dict_inv.iteritems():
+        qual_codes[score] = ord(char)
+    cons_seq = np.where(covered, base_codes[winners], ord('-')).astype(np.uint8)
+    cons_qual = np.where(covered, qual_codes[winner_quals], ord('-')).astype(np.uint8)
+
+    return cons_seq.tostring(), cons_qual.tostring()
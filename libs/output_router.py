@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Routes reads that are set aside during SAM processing (unmapped reads and
+# reads from contaminant references such as the phiX spike-in) to a fasta
+# file per category. Each file is opened once, on its first read, and
+# written through a buffered SeqWriter, rather than being reopened for every
+# read. Counts and bytes written are kept per category for the log file.
+#
+
+import os
+from bio_file_parsers import SeqWriter
+
+# Reads that map to neither J nor V
+UNMAPPED = ('unmapped', 'unmapped_reads.fasta')
+
+# J index reference name, category and output file of each contaminant.
+# Reads are counted in the metrics under '<category>_count'.
+CONTAMINANTS = [('phiX174', 'phiX', 'phiX174_reads.fasta'),
+                ('pUPATrap-CRV2_vector', 'pUPATrap', 'pUPATrap.fasta')]
+
+class OutputRouter:
+    """ Owns a fasta SeqWriter for each (category, file name) in categories,
+        with files in out_dir. Files are opened for appending the first time
+        a read is written to them, so categories with no reads leave no file.
+    """
+
+    def __init__(self, out_dir, categories):
+        self.out_dir = out_dir
+        self.categories = [category for category, _ in categories]
+        self.file_names = dict(categories)
+        self.writers = {}
+        self.reads = dict([(category, 0) for category in self.categories])
+
+    def write(self, category, header, seq, size=1):
+        """ Writes a read to the file for category. size is the number of raw
+            reads it stands for (its ;size= annotation).
+        """
+        writer = self.writers.get(category)
+        if writer is None:
+            out_file = os.path.join(self.out_dir, self.file_names[category])
+            writer = SeqWriter(open(out_file, 'a'))
+            self.writers[category] = writer
+        writer.write(header, seq)
+        self.reads[category] += size
+
+    def stats(self):
+        """ Returns a list of (category, file name, records, reads, bytes)
+            in category order.
+        """
+        stats = []
+        for category in self.categories:
+            writer = self.writers.get(category)
+            records = writer.count if writer else 0
+            num_bytes = writer.bytes_written if writer else 0
+            stats.append((category, self.file_names[category], records,
+                          self.reads[category], num_bytes))
+        return stats
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+def sam_output_router(out_dir):
+    """ Returns an OutputRouter for the unmapped and contaminant reads of a
+        run, as used by process_target_sam.parse_sams.
+    """
+    return OutputRouter(out_dir, [UNMAPPED] + [(cat, name) for _, cat, name in CONTAMINANTS])
+
+def format_stats(stats):
+    """ Returns log file lines for the stats from OutputRouter.stats.
+    """
+    lines = []
+    for category, file_name, records, reads, num_bytes in stats:
+        lines.append('{0} ({1}):\t{2} records\t{3} reads\t{4} bytes'.format(
+            category, file_name, records, reads, num_bytes))
+    return lines
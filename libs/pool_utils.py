@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Helpers for splitting up and running work over a multiprocessing Pool.
+#
+
+from collections import deque
+from itertools import islice
+
+def pool_map_ordered(pool, func, items, window):
+    """ Yields func(item) for each item, run in pool with up to window
+        items in flight, in order. Unlike Pool.imap, items are taken from
+        the iterator in this thread, so errors raised by it (or use of
+        objects tied to this thread) are not lost in the pool's feeder thread.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def read_chunks(records, chunk_size):
+    """ Yields lists of up to chunk_size records.
+    """
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            return
+        yield chunk
@@ -1,8 +1,11 @@
 # pypy script <in_fasta> <out_fasta>
 
-import pyximport; pyximport.install()
-import probabilistic_detection
 import sys
+try:
+    # Built ahead of time by setup_cython.py
+    import probabilistic_detection
+except ImportError:
+    sys.exit('probabilistic_detection is not built. Run: cd libs && python setup_cython.py build_ext --inplace')
 
 def main():
     
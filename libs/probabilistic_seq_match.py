@@ -1,6 +1,18 @@
 # cython script <in_fasta> <out_fasta>
 
+from math import log
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Number of Phred scores with a fastq quality character (offset 33, '!' to '~')
+NUM_QUALS = 94
+
+# Columns scored at a time by sequences_match_log_probs before dropping
+# targets that are already below stop_thresh
+BLOCK_SIZE = 32
 
 def sequences_match_prob(a_seq, a_qual, b_seq, b_qual, base_prob_precompute, stop_thresh):
     """ Given two sequences and their quality scores
@@ -12,10 +24,10 @@ def sequences_match_prob(a_seq, a_qual, b_seq, b_qual, base_prob_precompute, sto
     # For each base
     for i in range(len(a_seq)):
         # If Either is N, then prob is 0.25
-        if a_seq[i] == 'N' or b_seq == 'N':
+        if a_seq[i] == 'N' or b_seq[i] == 'N':
             #~ match_prob = 0.25
             match_prob = 1 # Permissive with Ns
-        elif a_seq[i] == '-' or b_seq == '-':
+        elif a_seq[i] == '-' or b_seq[i] == '-':
             match_prob = 1 # Permissive with '-'s
         else:
             # Calculate the base probabilities
@@ -33,6 +45,52 @@ def sequences_match_prob(a_seq, a_qual, b_seq, b_qual, base_prob_precompute, sto
             return prob
     return prob
 
+def sequences_match_log_probs(a_seq, a_qual, b_seqs, b_quals, stop_thresh=0, offset=33,
+                              block_size=BLOCK_SIZE):
+    """ Returns a numpy array of the log of sequences_match_prob of a_seq
+        against each of b_seqs, which must all be the same length as a_seq.
+        The per base log probs are looked up from the LOG_MATCH and
+        LOG_MISMATCH tables. Targets are scored block_size bases at a time
+        and those below stop_thresh after a block are not scored further,
+        so as with sequences_match_prob their value is then only known to
+        be below log(stop_thresh).
+    """
+    num_seqs = len(b_seqs)
+    seq_len = len(a_seq)
+    log_probs = np.zeros(num_seqs)
+    if num_seqs == 0 or seq_len == 0:
+        return log_probs
+
+    a_arr = np.frombuffer(a_seq, dtype=np.uint8)
+    a_scores = np.frombuffer(a_qual, dtype=np.uint8).astype(np.intp) - offset
+    b_arr = np.frombuffer(''.join(b_seqs), dtype=np.uint8).reshape(num_seqs, seq_len)
+    b_scores = np.frombuffer(''.join(b_quals), dtype=np.uint8).reshape(num_seqs, seq_len)
+    b_scores = b_scores.astype(np.intp) - offset
+
+    # Bases where either seq is N or '-' are permissive (log prob 0)
+    a_skip = (a_arr == ord('N')) | (a_arr == ord('-'))
+    b_skip = (b_arr == ord('N')) | (b_arr == ord('-'))
+
+    log_stop = log(stop_thresh) if stop_thresh > 0 else -np.inf
+    active = np.arange(num_seqs)
+    for start in xrange(0, seq_len, block_size):
+        end = start + block_size
+        block_b = b_arr[active, start:end]
+        block_scores = b_scores[active, start:end]
+        block_a_scores = a_scores[start:end]
+        block_log_probs = np.where(block_b == a_arr[start:end],
+                                   LOG_MATCH[block_a_scores, block_scores],
+                                   LOG_MISMATCH[block_a_scores, block_scores])
+        block_log_probs[a_skip[start:end] | b_skip[active, start:end]] = 0
+        log_probs[active] += block_log_probs.sum(axis=1)
+
+        # Stop scoring targets already below the threshold
+        active = active[log_probs[active] >= log_stop]
+        if not active.size:
+            break
+
+    return log_probs
+
 def match_given_mismatch_prob(x_prob, y_prob):
     """ Gives the prob of true match given two bases match.
     """
@@ -52,6 +110,18 @@ def base_prob(phred_score):
     prob = 10.0**(-float(phred_score)/10)
     return prob
 
+def log_prob_tables():
+    """ Returns NUM_QUALS x NUM_QUALS numpy arrays of the log of
+        match_given_match_prob and match_given_mismatch_prob for each pair
+        of Phred scores.
+    """
+    base_probs = [base_prob(x) for x in range(NUM_QUALS)]
+    log_match = np.array([[log(match_given_match_prob(x, y)) for y in base_probs]
+                          for x in base_probs])
+    log_mismatch = np.array([[log(match_given_mismatch_prob(x, y)) for y in base_probs]
+                             for x in base_probs])
+    return log_match, log_mismatch
+
 def phred_score(letter, offset, ascii):
     """ Returns the Phred score of a fastq quality character.
     """
@@ -65,3 +135,14 @@ def phred_score(letter, offset, ascii):
         score += 1
     # If no score is found then there must be an error
     raise ValueError, 'Invalid fastq quality character'
+
+if np is not None:
+    LOG_MATCH, LOG_MISMATCH = log_prob_tables()
+
+# Use the compiled sequences_match_prob if it has been built (see
+# setup_cython.py), keeping the python version for comparison
+python_sequences_match_prob = sequences_match_prob
+try:
+    from fast_seq_match import sequences_match_prob
+except ImportError:
+    pass
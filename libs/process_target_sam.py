@@ -3,10 +3,25 @@
 import os
 import sys
 import pysam
+from itertools import chain
+from multiprocessing import Pool
 #~ from libs.bio_file_parsers import write_fasta
-from bio_file_parsers import write_fasta, fastq_parser
+from bio_file_parsers import fastq_parser, SeqWriter
+from seq_index import IndexedReads
+from sam_stream import SamStream
+from output_router import sam_output_router, CONTAMINANTS
+from seq_utils import reverse_complement, alignment_record
+from pool_utils import pool_map_ordered
 
-class Read:
+# Number of J/V pairs sent to a pool process at a time and the number of
+# chunks that can be waiting on the pool per process
+CHUNK_SIZE = 10000
+CHUNKS_PER_CPU = 2
+
+class Read(object):
+
+    __slots__ = ['query_name', 'j_ref', 'v_ref', 'j_del', 'v_del', 'insert_start',
+                 'insert_end', 'is_phix']
     
     def __init__(self, query_name):
         self.query_name = str(query_name)
@@ -58,11 +73,36 @@ def main(args):
                                     args['out_dir'], args['fastq_in'])
     
 
-def parse_sams(j_sam, v_sam, out_dir, fastq_in):
+def parse_sams(j_sam, v_sam, out_dir, fastq_in, indexed=False, one_pass=False, num_cpu=1,
+               chunk_size=CHUNK_SIZE, router=None, screened=None, cache=None):
+    """ Walks the --reorder'ed J and V SAMs together, writing unmapped, phiX
+        and vector reads to their own fasta and the N-D-N region of each
+        mapped read to a fastq. If indexed is True the reads are fetched by
+        name from an mmapped index of fastq_in as each pair is processed,
+        rather than rescanning fastq_in afterwards. If one_pass is True the
+        seq and qual carried in the J SAM are used instead, so fastq_in is
+        not read at all.
+
+        j_sam and v_sam can be file names or streams of SAM text (see
+        open_sam), so bowtie2 output can be read straight from its stdout.
+
+        If num_cpu is more than 1 the pairs are classified in chunks of
+        chunk_size by a pool of processes (see classify_pair). The output is
+        the same as with 1.
+
+        If contaminant reads were screened out before alignment (see
+        kmer_screen.screen_fastq) pass the router they were written to and
+        the returned dict of reads per category as router and screened, so
+        they are included in the metrics. The router is closed on return.
+
+        If cache (an alignment_cache.AlignmentCache) is given, the SAMs only
+        hold the reads written by cache.split_fastq and the alignments of
+        the other reads in fastq_in come from the cache.
+    """
     
     # Open sam iterators
-    j_handle = pysam.Samfile(j_sam, 'r')
-    v_handle = pysam.Samfile(v_sam, 'r')
+    j_handle = open_sam(j_sam)
+    v_handle = open_sam(v_sam)
     j_iter = j_handle.fetch()
     v_iter = v_handle.fetch()
         
@@ -73,91 +113,110 @@ def parse_sams(j_sam, v_sam, out_dir, fastq_in):
     
     # File names
     ndn_fastq = os.path.join(out_dir, 'NDN_reads.fastq')
-    phix_fasta = os.path.join(out_dir, 'phiX174_reads.fasta')
-    pUPATrap_fasta = os.path.join(out_dir, 'pUPATrap.fasta')
-    unmapped_fasta = os.path.join(out_dir, 'unmapped_reads.fasta')
+
+    # Unmapped and contaminant reads are written out by the router
+    if router is None:
+        router = sam_output_router(out_dir)
+    contaminants = contaminant_categories()
     
     # Counters
     metrics = {}
     metrics['total_count'] = 0
     metrics['unmapped_count'] = 0
-    metrics['phiX_count'] = 0
-    metrics['pUPATrap_count'] = 0
+    for _, category, _ in CONTAMINANTS:
+        metrics[category + '_count'] = 0
     metrics['mapped_count'] = 0
+
+    # Add reads screened out before alignment
+    if screened is not None:
+        for category, reads in screened.iteritems():
+            metrics['total_count'] += reads
+            metrics[category + '_count'] += reads
     
     # Dict to hold insert start and ends
     insert_pos = {}
+
+    # Open the N-D-N output now if it can be written as each pair is processed
+    if one_pass or indexed:
+        ndn_handle = open(ndn_fastq, 'w')
+        ndn_writer = SeqWriter(ndn_handle, 'fastq')
+        if not one_pass:
+            reads = IndexedReads(fastq_in)
     
-    # Iterate over J and V sams
-    for j_align in j_iter:
-        v_align = v_iter.next()
-        
-        # Get read size
-        read_size = int(str(j_align.qname).split('size=')[-1])
+    # Classify each J/V pair, in chunks across a pool of processes if
+    # num_cpu > 1. Results come back in SAM order either way.
+    pairs = sam_pairs(j_iter, v_iter)
+    if cache is not None:
+        pairs = cache.merge_pairs(fastq_in, pairs)
+    if num_cpu > 1:
+        pool = Pool(num_cpu, initializer=init_classify_worker,
+                    initargs=(ref_names['J'], v_handle.lengths, one_pass))
+        chunks = sam_pair_chunks(pairs, chunk_size, one_pass)
+        results = chain.from_iterable(pool_map_ordered(pool, classify_chunk, chunks,
+                                                       num_cpu * CHUNKS_PER_CPU))
+    else:
+        results = (classify_pair(j_align, v_align, ref_names['J'], v_handle.lengths,
+                                 contaminants, one_pass)
+                   for j_align, v_align in pairs)
+
+    for category, read_size, name, data in results:
         
         metrics['total_count'] += 1 * read_size
         
-        # Skip if both are not mapped
-        if j_align.is_unmapped and v_align.is_unmapped:
-            with open(unmapped_fasta, 'a') as out_handle:
-                write_fasta(out_handle, j_align.qname, j_align.seq)
-            metrics['unmapped_count'] += 1 * read_size
+        # Unmapped and contaminant reads go to their own files
+        if category != 'mapped':
+            router.write(category, name, data, read_size)
+            metrics[category + '_count'] += 1 * read_size
             continue
         
-        # Skip if read is phix
-        if not j_align.rname == -1:
-            if ref_names['J'][j_align.rname] == 'phiX174':
-                with open(phix_fasta, 'a') as out_handle:
-                    write_fasta(out_handle, j_align.qname, j_align.seq)
-                metrics['phiX_count'] += 1 * read_size
-                continue
-            elif ref_names['J'][j_align.rname] == 'pUPATrap-CRV2_vector':
-                with open(pUPATrap_fasta, 'a') as out_handle:
-                    write_fasta(out_handle, j_align.qname, j_align.seq)
-                metrics['pUPATrap_count'] += 1 * read_size
-                continue
-        
         metrics['mapped_count'] += 1 * read_size
-        
-        # Get V length of reference
-        v_ref_len = v_handle.lengths[v_align.rname]
-        
-        # Add details to read_record
-        read_record = Read(j_align.qname)
-        if not j_align.is_unmapped:
-            read_record.parse_J_attr(j_align)
-        if not v_align.is_unmapped:
-            read_record.parse_V_attr(v_align, v_ref_len)
+        header, insert_start, insert_end, ndn = data
                         
+        # Write N-D-N region straight away from the seq and qual in the J SAM
+        if one_pass:
+            ndn_seq, ndn_qual = ndn
+            # Seq len must be > 0
+            if len(ndn_seq) > 0:
+                ndn_writer.write(header, ndn_seq, ndn_qual)
+            continue
+
+        # Or if the read can be fetched
+        if indexed:
+            seq, qual = reads[name]
+            write_ndn_record(ndn_writer, header, seq, qual, insert_start, insert_end)
+            continue
+
         # Save header, insert start and end to dict
-        insert_pos[read_record.query_name] = (read_record.get_header(),
-                                              read_record.insert_start,
-                                              read_record.insert_end)
-    
-    # Iterate over the input fastq and output NDN regions
-    rev_comp_dict = {'A':'T', 'T':'A', 'G':'C', 'C':'G', 'N':'N'}
-    with open(ndn_fastq, 'w') as out_h:
-        with open(fastq_in, 'r') as in_h:
-            for title, seq, qual in fastq_parser(in_h):
-                if title in insert_pos:
-                    start = insert_pos[title][1]
-                    end = insert_pos[title][2]
-                    rev_comp = reverse_complement(seq, rev_comp_dict)[start:end]
-                    rev_qual = qual[::-1][start:end]
-                    # Seq len must be > 0
-                    if not len(rev_comp) > 0:
-                        continue
-                    # Make output
-                    out = ['@{0}'.format(insert_pos[title][0]),
-                           rev_comp,
-                           '+',
-                           rev_qual]
-                    out_h.write('\n'.join(out) + '\n')
-                
+        insert_pos[name] = (header, insert_start, insert_end)
+
+    if num_cpu > 1:
+        pool.close()
+        pool.join()
     
+    if one_pass:
+        ndn_writer.close()
+    elif indexed:
+        ndn_writer.close()
+        reads.close()
+    else:
+        # Iterate over the input fastq and output NDN regions
+        with open(ndn_fastq, 'w') as out_h:
+            with open(fastq_in, 'r') as in_h:
+                with SeqWriter(out_h, 'fastq') as ndn_writer:
+                    for title, seq, qual in fastq_parser(in_h):
+                        if title in insert_pos:
+                            header, start, end = insert_pos[title]
+                            write_ndn_record(ndn_writer, header, seq, qual, start, end)
+    
+    
+    router.close()
+
     # Print metrics
     for key, value in metrics.iteritems():
         print '{0}: {1}'.format(key, value)
+
+    # Per file output stats for the log
+    metrics['outputs'] = router.stats()
     
     # Close sam iterators
     j_handle.close()
@@ -165,9 +224,113 @@ def parse_sams(j_sam, v_sam, out_dir, fastq_in):
     
     return ref_names, metrics, ndn_fastq
 
-def reverse_complement(seq, rev_comp_dict):
-    rev_list = list(seq.upper())
-    return ''.join([rev_comp_dict[x] for x in rev_list])[::-1]
+def sam_pairs(j_iter, v_iter):
+    """ Yields (J, V) alignment pairs from the --reorder'ed SAM iterators.
+    """
+    for j_align in j_iter:
+        v_align = next(v_iter, None)
+        if v_align is None:
+            raise ValueError('V SAM has fewer alignments than J SAM')
+        yield j_align, v_align
+
+def sam_pair_chunks(pairs, chunk_size, one_pass):
+    """ Yields lists of up to chunk_size pairs, with each alignment copied
+        into an AlignmentRecord so it can be sent to another process. The J
+        qual is only kept if one_pass is True.
+    """
+    chunk = []
+    for j_align, v_align in pairs:
+        chunk.append((alignment_record(j_align, one_pass),
+                      alignment_record(v_align, False)))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def init_classify_worker(j_names, v_lengths, one_pass):
+    """ Sets the globals used by classify_chunk in a pool process.
+    """
+    global worker_args
+    worker_args = (j_names, v_lengths, contaminant_categories(), one_pass)
+
+def classify_chunk(chunk):
+    return [classify_pair(j_align, v_align, *worker_args) for j_align, v_align in chunk]
+
+def classify_pair(j_align, v_align, j_names, v_lengths, contaminants, one_pass):
+    """ Classifies a J/V alignment pair. Returns (category, read size,
+        name, data) where category is 'unmapped', a contaminant category or
+        'mapped'. data is the read seq for unmapped and contaminant reads and
+        (header, insert start, insert end, N-D-N) for mapped reads, where
+        N-D-N is the (seq, qual) of the region if one_pass is True, else None.
+    """
+    # Get read size
+    read_size = int(str(j_align.qname).split('size=')[-1])
+    
+    # Skip if both are not mapped
+    if j_align.is_unmapped and v_align.is_unmapped:
+        return 'unmapped', read_size, j_align.qname, j_align.seq
+    
+    # Skip if read is phix or another contaminant
+    if not j_align.rname == -1:
+        category = contaminants.get(j_names[j_align.rname])
+        if category is not None:
+            return category, read_size, j_align.qname, j_align.seq
+    
+    # Get V length of reference
+    v_ref_len = v_lengths[v_align.rname]
+    
+    # Add details to read_record
+    read_record = Read(j_align.qname)
+    if not j_align.is_unmapped:
+        read_record.parse_J_attr(j_align)
+    if not v_align.is_unmapped:
+        read_record.parse_V_attr(v_align, v_ref_len)
+    start, end = read_record.insert_start, read_record.insert_end
+
+    # Cut out the N-D-N region using the seq and qual in the J SAM
+    ndn = None
+    if one_pass:
+        rev_comp, rev_qual = sam_rev_comp(j_align)
+        ndn = (rev_comp[start:end], rev_qual[start:end])
+
+    return 'mapped', read_size, read_record.query_name, (read_record.get_header(), start, end, ndn)
+
+def contaminant_categories():
+    """ Returns a dict of J reference name to contaminant category.
+    """
+    return dict([(ref, cat) for ref, cat, _ in CONTAMINANTS])
+
+def write_ndn_record(writer, header, seq, qual, start, end):
+    """ Writes the N-D-N region (start:end of the reverse complemented read)
+        to a fastq SeqWriter, skipping it if it is empty.
+    """
+    rev_comp = reverse_complement(seq.upper())[start:end]
+    rev_qual = qual[::-1][start:end]
+    # Seq len must be > 0
+    if not len(rev_comp) > 0:
+        return
+    writer.write(header, rev_comp, rev_qual)
+
+def sam_rev_comp(alignment):
+    """ Returns the reverse complement of the read in a SAM alignment and
+        its reversed qual. SAM stores reverse strand alignments already
+        reverse complemented, so these are used as they are.
+    """
+    if alignment.is_reverse:
+        return alignment.seq.upper(), alignment.qual
+    return reverse_complement(alignment.seq.upper()), alignment.qual[::-1]
+
+def open_sam(sam):
+    """ Opens a SAM file name with pysam. A SamStream (or anything else with
+        the same fetch interface, e.g. from gene_aligner) is returned as it is
+        and any other file-like object is read as a stream of SAM text.
+    """
+    if isinstance(sam, basestring):
+        return pysam.Samfile(sam, 'r')
+    if hasattr(sam, 'fetch'):
+        return sam
+    return SamStream(sam)
 
 def get_ref_name_dict(sam_file):
     """ Given a sam file stream, it will return a dictionary of the reference
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Batch quality string summaries. Quality strings for a whole chunk of reads
+# are joined into one buffer and converted to Phred scores with numpy, so
+# there is no per-base dict lookup. Falls back to plain python if numpy isn't
+# available (e.g. under pypy).
+#
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def quality_summaries(quals, offset=33):
+    """ Given a list of qual strings, returns lists of the mean Phred score,
+        min Phred score and expected number of errors of each.
+    """
+    if np is None:
+        means, mins, exp_errs = [], [], []
+        for scores in phred_scores(quals, offset):
+            means.append(sum(scores) / len(scores))
+            mins.append(min(scores))
+            exp_errs.append(sum([10.0 ** (-x / 10) for x in scores]))
+        return means, mins, exp_errs
+
+    if not quals:
+        return [], [], []
+
+    scores, starts, lengths = _joined_scores(quals, offset)
+    means = np.add.reduceat(scores, starts) / lengths.astype(np.float64)
+    mins = np.minimum.reduceat(scores, starts).astype(np.float64)
+    exp_errs = np.add.reduceat(10.0 ** (-scores / 10.0), starts)
+
+    return means.tolist(), mins.tolist(), exp_errs.tolist()
+
+def mean_phred_scores(quals, offset=33):
+    """ Given a list of qual strings, returns a list of their mean Phred
+        scores, the sum of the scores divided by the length of each.
+    """
+    if np is None:
+        return [sum(x) / len(x) for x in phred_scores(quals, offset)]
+
+    if not quals:
+        return []
+
+    scores, starts, lengths = _joined_scores(quals, offset)
+    means = np.add.reduceat(scores, starts) / lengths.astype(np.float64)
+
+    return means.tolist()
+
+def phred_scores(quals, offset=33):
+    """ Given a list of qual strings, returns a list of float Phred scores
+        for each.
+    """
+    if np is None:
+        return [[float(ord(x) - offset) for x in qual] for qual in quals]
+
+    # Equal length strings (e.g. padded cluster members) can be done in one go
+    lengths = set([len(x) for x in quals])
+    if len(lengths) == 1 and 0 not in lengths:
+        scores = np.frombuffer(''.join(quals), dtype=np.uint8).astype(np.float64) - offset
+        return scores.reshape(len(quals), lengths.pop()).tolist()
+
+    return [(np.frombuffer(x, dtype=np.uint8).astype(np.float64) - offset).tolist() if x else [] for x in quals]
+
+def _joined_scores(quals, offset):
+    """ Returns the Phred scores of all quals as one int64 array, along with
+        the start index and length of each qual in it.
+    """
+    lengths = np.array([len(x) for x in quals], dtype=np.int64)
+    if (lengths == 0).any():
+        raise ZeroDivisionError('Empty quality string')
+    starts = np.zeros(len(quals), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    scores = np.frombuffer(''.join(quals), dtype=np.uint8).astype(np.int64) - offset
+
+    return scores, starts, lengths
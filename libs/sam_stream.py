@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Minimal parser for SAM text read from a stream, such as the stdout of a
+# bowtie2 process, so alignments can be processed without the SAM being
+# written to disk. Gives the parts of the pysam Samfile/AlignedRead interface
+# used by process_target_sam (references, lengths, getrname, fetch and the
+# qname, rname, pos, qstart, qend, aend, seq and qual attributes of each
+# alignment), with the same 0 based coordinates.
+#
+# Every line read can also be copied to a tee handle, e.g. the stdin of a
+# 'samtools view -b' process to keep a compressed BAM for auditing.
+#
+
+import re
+
+cigar_pattern = re.compile(r'([0-9]+)([MIDNSHP=X])')
+
+# CIGAR operations that consume the query and the reference
+QUERY_OPS = set('MIS=X')
+REF_OPS = set('MDN=X')
+
+class SamStream:
+    """ Reads SAM text from handle. The header is read straight away, the
+        alignments are then read one at a time by iterating or from fetch().
+    """
+
+    def __init__(self, handle, tee=None):
+        self.handle = handle
+        self.tee = tee
+
+        # Read header lines
+        self.header = []
+        refs = []
+        lens = []
+        line = self._readline()
+        while line and line[0] == '@':
+            self.header.append(line)
+            if line.startswith('@SQ'):
+                tags = dict([x.split(':', 1) for x in line.rstrip('\n').split('\t')[1:]])
+                refs.append(tags['SN'])
+                lens.append(int(tags['LN']))
+            line = self._readline()
+        self._first = line
+
+        self.references = tuple(refs)
+        self.lengths = tuple(lens)
+        self.nreferences = len(refs)
+        self._ref_ids = dict([(name, i) for i, name in enumerate(refs)])
+
+    def _readline(self):
+        line = self.handle.readline()
+        if self.tee is not None and line:
+            self.tee.write(line)
+        return line
+
+    def getrname(self, tid):
+        """ Returns the name of reference number tid.
+        """
+        return self.references[tid]
+
+    def fetch(self):
+        """ Returns an iterator over the alignments.
+        """
+        return self
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._first is not None:
+            line = self._first
+            self._first = None
+        else:
+            line = self._readline()
+        if not line:
+            raise StopIteration
+        return SamRecord(line, self._ref_ids)
+
+    def close(self):
+        self.handle.close()
+
+class SamRecord(object):
+    """ One SAM alignment line, with pysam style attributes.
+    """
+
+    __slots__ = ['qname', 'flag', 'rname', 'pos', 'mapq', 'cigarstring', 'seq',
+                 'qual', 'qstart', 'qend', 'aend']
+
+    def __init__(self, line, ref_ids):
+        fields = line.rstrip('\n').split('\t', 11)
+        self.qname = fields[0]
+        self.flag = int(fields[1])
+        self.rname = ref_ids.get(fields[2], -1)
+        self.pos = int(fields[3]) - 1
+        self.mapq = int(fields[4])
+        self.cigarstring = fields[5]
+        self.seq = fields[9] if fields[9] != '*' else None
+        self.qual = fields[10] if fields[10] != '*' else None
+
+        # Aligned part of the query and end of the alignment on the reference
+        if self.cigarstring == '*':
+            self.qstart = 0
+            self.qend = len(self.seq) if self.seq else 0
+            self.aend = None
+        else:
+            cigar = [(int(n), op) for n, op in cigar_pattern.findall(self.cigarstring)]
+            query_len = sum([n for n, op in cigar if op in QUERY_OPS])
+            ref_len = sum([n for n, op in cigar if op in REF_OPS])
+            clips = [n if op == 'S' else 0 for n, op in cigar if op != 'H']
+            self.qstart = clips[0]
+            self.qend = query_len - clips[-1]
+            self.aend = self.pos + ref_len
+
+    @property
+    def tid(self):
+        return self.rname
+
+    @property
+    def is_unmapped(self):
+        return bool(self.flag & 4)
+
+    @property
+    def is_reverse(self):
+        return bool(self.flag & 16)
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# A .fai style index for fasta and fastq files so that records can be fetched
+# by header without loading the whole file into memory. The index maps a
+# 64 bit hash of each header to the byte offset and length of its record and
+# is stored as a compact binary file next to the sequence file. Both files
+# are read through mmap, so processes forked after opening share the pages.
+#
+# Index file layout (little endian):
+#   magic 'NMRDIDX1', format ('a' fasta or 'q' fastq), number of records (Q),
+#   then per record, sorted by hash: hash (Q), offset (Q), length (I)
+#
+
+import os
+import mmap
+import struct
+from hashlib import md5
+
+MAGIC = 'NMRDIDX1'
+HEADER = struct.Struct('<8scQ')
+ENTRY = struct.Struct('<QQI')
+
+def header_hash(header):
+    """ Returns a 64 bit int hash of a record header.
+    """
+    return struct.unpack('<Q', md5(header).digest()[:8])[0]
+
+def build_index(seq_file, index_file=None):
+    """ Scans seq_file and writes its index, by default to seq_file + '.idx'.
+        The format is taken from the first record. Returns the index file name.
+    """
+    if index_file is None:
+        index_file = seq_file + '.idx'
+
+    with open(seq_file, 'rb') as in_handle:
+        first = in_handle.read(1)
+        in_handle.seek(0)
+        if first == '>':
+            fmt = 'a'
+            entries = [(header_hash(t), o, l) for t, o, l in fasta_offsets(in_handle)]
+        else:
+            fmt = 'q'
+            entries = [(header_hash(t), o, l) for t, o, l in fastq_offsets(in_handle)]
+    entries.sort()
+
+    with open(index_file, 'wb') as out_handle:
+        out_handle.write(HEADER.pack(MAGIC, fmt, len(entries)))
+        for entry in entries:
+            out_handle.write(ENTRY.pack(*entry))
+
+    return index_file
+
+def fasta_offsets(handle):
+    """ Yields (title, offset, length) for each record in a fasta handle.
+    """
+    offset = 0
+    start = 0
+    title = None
+    for line in handle:
+        if line[0] == '>':
+            if title is not None:
+                yield title, start, offset - start
+            title = line[1:].rstrip()
+            start = offset
+        offset += len(line)
+    if title is not None:
+        yield title, start, offset - start
+
+def fastq_offsets(handle):
+    """ Yields (title, offset, length) for each record in a fastq handle,
+        following the same multi-line rules as bio_file_parsers.fastq_parser.
+    """
+    readline = handle.readline
+    offset = 0
+
+    # Skip any text before the first record
+    line = readline()
+    while line and line[0] != '@':
+        offset += len(line)
+        line = readline()
+
+    while line:
+        start = offset
+        title = line[1:].rstrip()
+        offset += len(line)
+        # Sequence lines up to the '+' line
+        seq_len = 0
+        line = readline()
+        while line and line[0] != '+':
+            seq_len += len(line.rstrip())
+            offset += len(line)
+            line = readline()
+        offset += len(line)
+        # Quality lines until the next '@' line once there is enough quality
+        qual_len = 0
+        first = True
+        line = readline()
+        while line:
+            if not first and line[0] == '@' and qual_len >= seq_len:
+                break
+            first = False
+            qual_len += len(line.rstrip())
+            offset += len(line)
+            line = readline()
+        yield title, start, offset - start
+
+class IndexedReads:
+    """ Read only header -> record mapping over an indexed fasta/fastq. Fastq
+        lookups return (seq, qual) like make_fastq_dict and fasta lookups
+        return the seq. The index is built if it is missing or older than the
+        sequence file.
+    """
+
+    def __init__(self, seq_file, index_file=None):
+        if index_file is None:
+            index_file = seq_file + '.idx'
+        if (not os.path.exists(index_file) or
+                os.path.getmtime(index_file) < os.path.getmtime(seq_file)):
+            build_index(seq_file, index_file)
+
+        self._seq_handle = open(seq_file, 'rb')
+        self._idx_handle = open(index_file, 'rb')
+        self._seqs = map_file(self._seq_handle)
+        self._idx = map_file(self._idx_handle)
+
+        magic, self.fmt, self.num_records = HEADER.unpack_from(self._idx, 0)
+        if magic != MAGIC:
+            raise ValueError('{0} is not a sequence index'.format(index_file))
+
+    def _entry(self, i):
+        return ENTRY.unpack_from(self._idx, HEADER.size + i * ENTRY.size)
+
+    def _find(self, header):
+        """ Returns (offset, length) of the record for header or None.
+        """
+        target = header_hash(header)
+
+        # Binary search for the first entry with this hash
+        lo, hi = 0, self.num_records
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(mid)[0] < target:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        # Check the header of each record with this hash
+        while lo < self.num_records:
+            entry_hash, offset, length = self._entry(lo)
+            if entry_hash != target:
+                break
+            end = self._seqs.find('\n', offset, offset + length)
+            if end == -1:
+                end = offset + length
+            if self._seqs[offset + 1:end].rstrip() == header:
+                return offset, length
+            lo += 1
+
+        return None
+
+    def __getitem__(self, header):
+        found = self._find(header)
+        if found is None:
+            raise KeyError(header)
+        offset, length = found
+        lines = self._seqs[offset:offset + length].split('\n')
+
+        if self.fmt == 'a':
+            return ''.join([x.rstrip() for x in lines[1:]]).replace(' ', '')
+
+        i = 1
+        while lines[i][:1] != '+':
+            i += 1
+        seq = ''.join([x.rstrip() for x in lines[1:i]])
+        qual = ''.join([x.rstrip() for x in lines[i + 1:]])
+        return seq, qual
+
+    def __contains__(self, header):
+        return self._find(header) is not None
+
+    def __len__(self):
+        return self.num_records
+
+    def get(self, header, default=None):
+        try:
+            return self[header]
+        except KeyError:
+            return default
+
+    def close(self):
+        for mapped in [self._seqs, self._idx]:
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+        self._seq_handle.close()
+        self._idx_handle.close()
+
+def map_file(handle):
+    """ Returns a read only mmap of handle, or '' if the file is empty (which
+        can't be mapped).
+    """
+    if os.fstat(handle.fileno()).st_size == 0:
+        return ''
+    return mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Compact dictionary keys for DNA sequences. Reads made up only of ACGT are
+# 2-bit packed into a single integer, which for a 250 bp read is roughly a
+# third of the size of the equivalent str. Reads containing any other
+# character (N, IUPAC codes, lowercase) are kept as their original str, so a
+# key is either an int/long (packed) or a str (side-channel) and the two can
+# never collide in the same dictionary.
+#
+
+from string import maketrans
+
+# ACGT as base 4 digits
+_TO_QUAT = maketrans('ACGT', '0123')
+
+def _make_bits_table():
+    """ Makes a dict of every 2, 4, 6 and 8 bit string to its bases, used to
+        unpack 4 bases at a time.
+    """
+    bases = {'00':'A', '01':'C', '10':'G', '11':'T'}
+    table = dict(bases)
+    for _ in range(3):
+        table.update(dict([(k + b, v + bases[b]) for k, v in table.items() for b in bases]))
+    return table
+
+_BITS_TO_BASES = _make_bits_table()
+
+def pack_seq(seq):
+    """ Returns a compact key for seq. ACGT only seqs are packed 2 bits per
+        base under a leading 1 bit, which records the length. Anything else is
+        returned unchanged.
+    """
+    if seq.translate(None, 'ACGT'):
+        return seq
+    return int('1' + seq.translate(_TO_QUAT), 4)
+
+def unpack_seq(key):
+    """ Returns the sequence for a key made by pack_seq.
+    """
+    if isinstance(key, str):
+        return key
+    # Strip '0b' and the leading length bit
+    bits = bin(key)[3:]
+    return ''.join([_BITS_TO_BASES[bits[i:i + 8]] for i in xrange(0, len(bits), 8)])
+
+class PackedFastqDict(dict):
+    """ A header -> (seq, qual) dict that stores seq packed with pack_seq and
+        unpacks it again on lookup. Can be used in place of the dict returned
+        by make_fastq_dict.
+    """
+
+    def __setitem__(self, header, record):
+        seq, qual = record
+        dict.__setitem__(self, header, (pack_seq(seq), qual))
+
+    def __getitem__(self, header):
+        key, qual = dict.__getitem__(self, header)
+        return unpack_seq(key), qual
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Shared sequence helpers: a str.translate based (reverse) complement that
+# handles IUPAC codes and lowercase, and a light record for the alignment
+# attributes used when processing SAMs.
+#
+
+from string import maketrans
+from collections import namedtuple
+
+# Complement of each IUPAC nucleotide code, keeping case. Any other
+# character (e.g. '-' padding) is left as it is.
+COMPLEMENT_TABLE = maketrans('ACGTUNRYSWKMBDHVacgtunryswkmbdhv',
+                             'TGCAANYRSWMKVHDBtgcaanyrswmkvhdb')
+
+# Alignment attributes used by process_target_sam, with the same meaning
+# and 0 based coordinates as pysam. Unlike pysam objects these can be
+# pickled and sent to other processes.
+AlignmentRecord = namedtuple('AlignmentRecord', ['qname', 'is_unmapped', 'is_reverse',
+                                                 'rname', 'pos', 'qstart', 'qend', 'aend',
+                                                 'seq', 'qual'])
+
+def complement(seq):
+    """ Returns the complement of a DNA/RNA seq.
+    """
+    return seq.translate(COMPLEMENT_TABLE)
+
+def reverse_complement(seq):
+    """ Returns the reverse complement of a DNA/RNA seq.
+    """
+    return seq.translate(COMPLEMENT_TABLE)[::-1]
+
+def alignment_record(alignment, keep_qual=True):
+    """ Copies the attributes of a pysam (or SamStream) alignment into an
+        AlignmentRecord. The qual is dropped if keep_qual is False.
+    """
+    qual = alignment.qual if keep_qual else None
+    return AlignmentRecord(alignment.qname, alignment.is_unmapped, alignment.is_reverse,
+                           alignment.rname, alignment.pos, alignment.qstart, alignment.qend,
+                           alignment.aend, alignment.seq, qual)
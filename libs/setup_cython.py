@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Builds the Cython extensions in libs ahead of time, so they are not
+# compiled by pyximport when a script starts. Run from libs (install.py
+# does this) with
+#
+#   python setup_cython.py build_ext --inplace
+#
+# fast_seq_match is optional; without it the pure python versions in
+# probabilistic_seq_match and make_cluster_consensus are used.
+#
+
+from distutils.core import setup
+from distutils.extension import Extension
+from Cython.Build import cythonize
+
+extensions = [Extension('fast_seq_match', ['fast_seq_match.pyx'],
+                        extra_compile_args=['-O3']),
+              Extension('probabilistic_detection', ['probabilistic_detection.pyx'])]
+
+setup(name='NHS_MRD2 extensions',
+      ext_modules=cythonize(extensions, compiler_directives={'language_level': 2}))
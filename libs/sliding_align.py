@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Vectorised version of make_cluster_consensus.align_seq. Rather than
+# counting matches for each offset of member against centroid in turn, each
+# base present in both seqs is one-hot encoded and the matches at every
+# offset are counted at once by convolving the centroid with the reversed
+# member. As in align_seq, N never counts as a match, offsets must overlap
+# more than half of the centroid and the first best scoring offset wins.
+#
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def offset_scores(centroid, other):
+    """ Returns an array of the number of matching (non N) bases at each
+        offset i of align_seq, at index i - 1.
+    """
+    cen_arr = np.frombuffer(centroid, dtype=np.uint8)
+    other_arr = np.frombuffer(other, dtype=np.uint8)[::-1]
+    scores = np.zeros(len(centroid) + len(other) - 1, dtype=np.int64)
+    for base in set(centroid) & set(other):
+        if base == 'N':
+            continue
+        scores += np.convolve((cen_arr == ord(base)).astype(np.int64),
+                              (other_arr == ord(base)).astype(np.int64))
+    return scores
+
+def best_offset(centroid, other):
+    """ Returns the offset i (as in align_seq) with the most matches, or None
+        if no offset overlapping more than half the centroid has a match.
+    """
+    cen_len = len(centroid)
+    other_len = len(other)
+    scores = offset_scores(centroid, other)
+
+    # Overlap of the seqs at each offset
+    offsets = np.arange(1, cen_len + other_len)
+    overlap = np.minimum(offsets, cen_len) - np.maximum(0, offsets - other_len)
+    scores[overlap <= cen_len // 2] = 0
+
+    best_index = int(np.argmax(scores))
+    if scores[best_index] <= 0:
+        return None
+    return best_index + 1
+
+def align_seq(centroid, other):
+    """ Returns the (front, back) front/back are the numer of insertions or del
+        of the other compared to the centroid. Same result as
+        make_cluster_consensus.align_seq.
+    """
+    best_index = best_offset(centroid, other)
+
+    # Convert into shorthand, ins/del at front and back of other
+    front = len(other) - best_index
+    back = best_index - len(centroid)
+    return (front, back)